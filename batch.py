@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import argparse
+from time import perf_counter
+from zag import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ['frame_dtype', 'pack_records', 'decode_batch']
+
+if np is not None:
+    frame_dtype = np.dtype([
+        ('frame_control', 'u2'),
+        ('frame_type', 'u1'),
+        ('seq_num', 'u1'),
+        ('supported', '?'),
+        ('dst_mode', 'u1'),
+        ('src_mode', 'u1'),
+        ('dst_panid', 'u2'),
+        ('dst_addr', 'u8'),
+        ('src_panid', 'u2'),
+        ('src_addr', 'u8'),
+        ('identifier', 'u1'),
+        ('rssi', 'i1'),
+        ('link_quality', 'u1'),
+        ('payload_offset', 'u4'),
+        ('payload_length', 'u2'),
+    ])
+else:
+    frame_dtype = None
+
+def require_numpy():
+    if np is None:
+        raise ImportError('batch decoding requires numpy')
+
+def pack_records(records):
+    require_numpy()
+    buffer = bytearray()
+    offsets, rssi, link_quality = [], [], []
+    for _, packet, frame_rssi, frame_link_quality in records:
+        offsets.append(len(buffer))
+        buffer += packet
+        rssi.append(frame_rssi)
+        link_quality.append(frame_link_quality)
+    return (bytes(buffer), np.array(offsets, dtype=np.int64),
+            np.array(rssi, dtype=np.int8), np.array(link_quality, dtype=np.uint8))
+
+def gather(buf, offsets, size):
+    value = np.zeros(len(offsets), dtype=np.uint64)
+    for i in range(size):
+        value = (value << np.uint64(8)) | buf[offsets + i].astype(np.uint64)
+    return value
+
+def decode_batch(buffer, offsets, lengths=None, rssi=None, link_quality=None):
+    require_numpy()
+    buf = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if lengths is None:
+        lengths = np.diff(np.append(offsets, len(buf)))
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    frames = np.zeros(len(offsets), dtype=frame_dtype)
+    if rssi is not None:
+        frames['rssi'] = rssi
+    if link_quality is not None:
+        frames['link_quality'] = link_quality
+    frames['payload_offset'] = offsets
+    frames['payload_length'] = lengths
+
+    rows = np.nonzero(lengths >= 3)[0]
+    starts = offsets[rows]
+    frame_control = (buf[starts].astype(np.uint16) << 8) | buf[starts + 1]
+    frames['frame_control'][rows] = frame_control
+    frames['frame_type'][rows] = frame_control & 0x7
+    frames['seq_num'][rows] = buf[starts + 2]
+    frames['dst_mode'][rows] = (frame_control >> MHR.FrameControl.dst_mode) & 0x3
+    frames['src_mode'][rows] = (frame_control >> MHR.FrameControl.src_mode) & 0x3
+
+    layout_keys = frame_control & MHR.layout_mask
+    for key in np.unique(layout_keys):
+        try:
+            layout = MHR.layout(int(key))
+        except ValueError:
+            continue
+        if not layout.supported:
+            continue
+        group = rows[layout_keys == key]
+        group = group[lengths[group] >= layout.size]
+        if not len(group):
+            continue
+        starts = offsets[group]
+        for field, (offset, code) in layout.offsets.items():
+            if field in ('frame_control', 'seq_num'):
+                continue
+            frames[field][group] = gather(buf, starts + offset, 2 if code == 'H' else 8)
+        frames['supported'][group] = True
+        frames['payload_offset'][group] = starts + layout.size
+        frames['payload_length'][group] = lengths[group] - layout.size
+
+    cmd = (frames['supported'] & (frames['frame_type'] == MHR.FrameType.cmd) & (frames['payload_length'] > 0))
+    frames['identifier'][cmd] = buf[frames['payload_offset'][cmd].astype(np.int64)]
+    return frames
+
+if __name__ == '__main__':
+    from replay import read_records
+
+    parser = argparse.ArgumentParser(description='Decode a capture in one batch and summarize it.')
+    parser.add_argument('capture', help='pcapng, pcap or JSON lines file')
+    args = parser.parse_args()
+
+    buffer, offsets, rssi, link_quality = pack_records(read_records(args.capture))
+    start = perf_counter()
+    frames = decode_batch(buffer, offsets, rssi=rssi, link_quality=link_quality)
+    elapsed = perf_counter() - start
+
+    print('frames:    %d' % len(frames))
+    print('decoded:   %.3f s (%.0f frames/s)' % (elapsed, len(frames) / elapsed if elapsed else 0))
+    print('supported: %d' % np.count_nonzero(frames['supported']))
+    types, counts = np.unique(frames['frame_type'], return_counts=True)
+    for frame_type, count in zip(types, counts):
+        try:
+            name = str(MHR.FrameType(int(frame_type)))
+        except ValueError:
+            name = str(frame_type)
+        print('  %-32s %d' % (name, count))
+    cmd = frames[frames['supported'] & (frames['frame_type'] == MHR.FrameType.cmd) & (frames['payload_length'] > 0)]
+    identifiers, counts = np.unique(cmd['identifier'], return_counts=True)
+    for identifier, count in zip(identifiers, counts):
+        try:
+            name = 'cmd.' + str(CMD.Identifier(int(identifier)))
+        except ValueError:
+            name = 'cmd.%d' % identifier
+        print('  %-32s %d' % (name, count))
+    if len(frames):
+        print('rssi:      min %d mean %.1f max %d' % (frames['rssi'].min(), frames['rssi'].mean(), frames['rssi'].max()))
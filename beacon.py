@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import metrics
+from time import monotonic
+
+__all__ = ['TokenBucket', 'BeaconResponder']
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    # Rounding slack, so a flush deferred by delay() always finds the token it waited for
+    epsilon = 1e-9
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1 - TokenBucket.epsilon:
+            return False
+        self.tokens -= 1
+        return True
+
+    def delay(self, now):
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+class BeaconResponder(object):
+    requests = metrics.registry.counter('zag_beacon_requests_total', 'Broadcast beacon requests received')
+    beacons = metrics.registry.counter('zag_beacons_sent_total', 'Beacons sent in response to beacon requests')
+    suppressed = metrics.registry.counter('zag_beacon_requests_coalesced_total', 'Beacon requests answered by a beacon already scheduled')
+    deferrals = metrics.registry.counter('zag_beacons_deferred_total', 'Times a beacon was delayed by the rate limit')
+
+    def __init__(self, send, scheduler, window=0.05, rate=10.0, burst=3):
+        self.send = send
+        self.scheduler = scheduler
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        # Per radio, since each radio serves its own channel
+        self.buckets = {}
+        self.timers = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.deferred = 0
+
+    def request(self, radio):
+        BeaconResponder.requests.inc()
+        if radio in self.timers:
+            self.coalesced += 1
+            BeaconResponder.suppressed.inc()
+            return
+        self.timers[radio] = self.scheduler.call_later(self.window, self.flush, radio)
+
+    def flush(self, radio):
+        # Follow the scheduler's clock so replayed traffic is rate limited in capture time
+        now = self.scheduler.clock()
+        bucket = self.buckets.get(radio)
+        if bucket is None:
+            bucket = self.buckets[radio] = TokenBucket(self.rate, self.burst, now)
+        if not bucket.take(now):
+            # Keep collecting requests until the bucket allows another beacon
+            self.deferred += 1
+            BeaconResponder.deferrals.inc()
+            self.timers[radio] = self.scheduler.call_later(bucket.delay(now), self.flush, radio)
+            return
+        del self.timers[radio]
+        self.sent += 1
+        BeaconResponder.beacons.inc()
+        self.send(radio)
+
+    def cancel(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+import argparse
+from collections import deque
+from contextlib import redirect_stdout
+import gc
+import json
+import os
+import random
+import struct
+import sys
+from threading import Lock, Semaphore
+from time import perf_counter
+import tracemalloc
+from zag import *
+
+class StreamSerial(object):
+    def __init__(self, data, chunk=4096, call_cost=0.0):
+        self.data = data
+        self.offset = 0
+        self.chunk = chunk
+        # Seconds each read spends in the kernel and pyserial on a real port
+        self.call_cost = call_cost
+        self.reads = 0
+
+    @property
+    def in_waiting(self):
+        return min(len(self.data) - self.offset, self.chunk)
+
+    def syscall(self, calls=1):
+        self.reads += calls
+        if self.call_cost:
+            deadline = perf_counter() + self.call_cost * calls
+            while perf_counter() < deadline:
+                pass
+
+    def read(self, n=1):
+        self.syscall()
+        data = self.data[self.offset:self.offset + n]
+        self.offset += len(data)
+        return data
+
+    def read_until(self, expected):
+        i = self.data.find(expected, self.offset)
+        end = len(self.data) if i < 0 else i + len(expected)
+        # pyserial reads one byte per call while looking for the terminator
+        self.syscall(end - self.offset - 1)
+        return self.read(end - self.offset)
+
+def make_stream(n, seed=0):
+    rand = random.Random(seed)
+    stream = bytearray(b'\xAAZAG')
+    for _ in range(n):
+        if rand.random() < 0.9:
+            data = bytes(rand.randrange(256) for _ in range(rand.randrange(5, 127)))
+            data += struct.pack('!bB', -rand.randrange(30, 90), rand.randrange(256))
+            stream += DEV.header_struct.pack(DEV.Event.on_packet, len(data)) + data
+        else:
+            stream += DEV.header_struct.pack(DEV.Response.ok, 2) + b'\x00\x00'
+    return bytes(stream)
+
+def legacy_reader(serial):
+    frames = 0
+    do_sync = True
+    while serial.offset < len(serial.data):
+        if do_sync:
+            data = serial.read_until(b'\xAAZAG')
+            if not data.endswith(b'\xAAZAG'):
+                continue
+            do_sync = False
+
+        data = serial.read(DEV.header_struct.size)
+        if len(data) != DEV.header_struct.size:
+            continue
+        response, data_len = DEV.header_struct.unpack(data)
+
+        data = serial.read(data_len)
+        if len(data) != data_len:
+            continue
+
+        if response & 0xC0 == 0xC0:
+            event = DEV.Event(response)
+            if event == DEV.Event.on_packet:
+                rssi, link_quality = struct.unpack('!bB', data[-2:])
+                data = (data[:-2], rssi)
+        frames += 1
+    return frames
+
+def framer_reader(serial):
+    frames = 0
+    framer = Framer()
+    while serial.offset < len(serial.data):
+        for response, data in framer.feed(serial.read(serial.in_waiting or 1)):
+            if response & 0xC0 == 0xC0:
+                event = DEV.Event(response)
+                if event == DEV.Event.on_packet:
+                    rssi, link_quality = struct.unpack_from('!bB', data, len(data) - 2)
+                    data = (bytes(data[:-2]), rssi)
+            frames += 1
+    return frames
+
+def legacy_mhr_decode(data):
+    mhr = MHR()
+
+    offset = 0
+    mhr.frame_control, mhr.seq_num = struct.unpack_from('!HB', data, offset)
+    if (mhr.frame_control >> MHR.FrameControl.version) & 0x3 > MHR.Version.version_2006:
+        return
+    offset += 3
+
+    dst_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.dst_mode) & 0x3)
+
+    if dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
+        mhr.dst_panid, = struct.unpack_from('!H', data, offset)
+        offset += 2
+
+    if dst_mode == MHR.AddrMode.short:
+        mhr.dst_addr, = struct.unpack_from('!H', data, offset)
+        offset += 2
+    elif dst_mode == MHR.AddrMode.long:
+        mhr.dst_addr = data[offset:offset + 8]
+        offset += 8
+
+    src_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.src_mode) & 0x3)
+
+    panid_compression = (mhr.frame_control >> MHR.FrameControl.panid_compression) & 1
+    if src_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
+        if panid_compression and dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
+            mhr.src_panid = mhr.dst_panid
+        else:
+            mhr.src_panid, = struct.unpack_from('!H', data, offset)
+            offset += 2
+
+    if src_mode == MHR.AddrMode.short:
+        mhr.src_addr, = struct.unpack_from('!H', data, offset)
+        offset += 2
+    elif src_mode == MHR.AddrMode.long:
+        mhr.src_addr = data[offset:offset + 8]
+        offset += 8
+
+    return mhr, data[offset:]
+
+def legacy_mhr_encode(mhr):
+    data = struct.pack('!HB', mhr.frame_control, mhr.seq_num)
+
+    dst_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.dst_mode) & 0x3)
+
+    if dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
+        data += struct.pack('!H', mhr.dst_panid)
+
+    if dst_mode == MHR.AddrMode.short:
+        data += struct.pack('!H', mhr.dst_addr)
+    elif dst_mode == MHR.AddrMode.long:
+        data += mhr.dst_addr
+
+    src_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.src_mode) & 0x3)
+
+    panid_compression = (mhr.frame_control >> MHR.FrameControl.panid_compression) & 1
+    if src_mode in [MHR.AddrMode.short, MHR.AddrMode.long] and not panid_compression:
+        data += struct.pack('!H', mhr.src_panid)
+
+    if src_mode == MHR.AddrMode.short:
+        data += struct.pack('!H', mhr.src_addr)
+    elif src_mode == MHR.AddrMode.long:
+        data += mhr.src_addr
+
+    return data
+
+def make_mhr(frame_type, dst_mode, src_mode, panid_compression=0, req_ack=0):
+    mhr = MHR()
+    mhr.frame_control |= frame_type << MHR.FrameControl.type
+    mhr.frame_control |= req_ack << MHR.FrameControl.req_ack
+    mhr.frame_control |= panid_compression << MHR.FrameControl.panid_compression
+    mhr.frame_control |= dst_mode << MHR.FrameControl.dst_mode
+    mhr.frame_control |= src_mode << MHR.FrameControl.src_mode
+    mhr.seq_num = 0x5A
+    mhr.dst_panid = 0xFFFF
+    mhr.dst_addr = 0xFFFF if dst_mode == MHR.AddrMode.short else b'\x01' * 8
+    mhr.src_panid = 0x1234
+    mhr.src_addr = 0x0000 if src_mode == MHR.AddrMode.short else b'\x02' * 8
+    return mhr
+
+def coordinator_headers():
+    return [
+        make_mhr(MHR.FrameType.ack, MHR.AddrMode.none, MHR.AddrMode.none),
+        make_mhr(MHR.FrameType.bcn, MHR.AddrMode.none, MHR.AddrMode.short),
+        make_mhr(MHR.FrameType.cmd, MHR.AddrMode.short, MHR.AddrMode.none),
+        make_mhr(MHR.FrameType.cmd, MHR.AddrMode.short, MHR.AddrMode.long, req_ack=1),
+        make_mhr(MHR.FrameType.cmd, MHR.AddrMode.long, MHR.AddrMode.long, 1, 1),
+    ]
+
+def best_of(fn, *args, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn(*args)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def bench_framing(n=20000, call_cost=5e-6):
+    stream = make_stream(n)
+    for cost in (0.0, call_cost):
+        print('read cost %.1f us' % (cost * 1e6))
+        results = {}
+        for name, reader in [('legacy_reader', legacy_reader), ('framer_reader', framer_reader)]:
+            serials = []
+
+            def run():
+                serials.append(StreamSerial(stream, call_cost=cost))
+                return reader(serials[-1])
+
+            elapsed, frames = best_of(run)
+            assert frames == n
+            results[name] = elapsed
+            print('%-16s %10.0f frames/s %8.0f ns/frame %8.3f reads/frame' % (
+                name, n / elapsed, elapsed * 1e9 / n, serials[-1].reads / n))
+        print('%-16s %10.2fx' % ('speedup', results['legacy_reader'] / results['framer_reader']))
+
+def bench_mhr(n=20000):
+    headers = coordinator_headers()
+    packets = [mhr.encode() + b'\x07' for mhr in headers] * (n // len(headers))
+    for packet in packets[:len(headers)]:
+        assert vars(legacy_mhr_decode(packet)[0]) == vars(MHR.decode(packet)[0])
+    headers = [MHR.decode(packet)[0] for packet in packets]
+
+    cases = [
+        ('legacy_decode', lambda: [legacy_mhr_decode(packet) for packet in packets]),
+        ('decode', lambda: [MHR.decode(packet) for packet in packets]),
+        ('legacy_encode', lambda: [legacy_mhr_encode(mhr) for mhr in headers]),
+        ('encode', lambda: [mhr.encode() for mhr in headers]),
+    ]
+    results = {}
+    for name, fn in cases:
+        elapsed, _ = best_of(fn)
+        results[name] = elapsed
+        print('%-16s %10.0f frames/s %8.0f ns/frame' % (name, len(packets) / elapsed, elapsed * 1e9 / len(packets)))
+    print('%-16s %10.2fx' % ('decode speedup', results['legacy_decode'] / results['decode']))
+    print('%-16s %10.2fx' % ('encode speedup', results['legacy_encode'] / results['encode']))
+
+class EventSink(deque):
+    put_nowait = deque.append
+
+def make_reader_dev(stream):
+    dev = DEV.__new__(DEV)
+    dev.serial = StreamSerial(stream)
+    dev.framer = Framer()
+    dev.lock = Lock()
+    dev.window = Semaphore(4)
+    dev.pending = deque()
+    dev.event_queue = EventSink()
+    dev.capture = None
+    return dev
+
+def dev_reader(stream):
+    dev = make_reader_dev(stream)
+    serial = dev.serial
+    while serial.offset < len(serial.data):
+        dev.feed(serial.read(serial.in_waiting or 1))
+    return dev.event_queue
+
+def make_bcn(gts=False, pend_addr=False):
+    bcn = BCN()
+    bcn.superframe = 0xCFFF
+    bcn.ssid = 'Sample'
+    bcn.services = [1, 2, 3]
+    if gts:
+        bcn.gts_spec = (1 << BCN.GtsSpec.permit) | 2
+        bcn.gts_mask = 0x01
+        bcn.gts_desc = [(2 << BCN.GtsDescriptor.gts_length) | (9 << BCN.GtsDescriptor.start_slot) | 0x0001,
+                        (1 << BCN.GtsDescriptor.gts_length) | (11 << BCN.GtsDescriptor.start_slot) | 0x0002]
+    if pend_addr:
+        bcn.pend_addr = [0x0003, 0x0004, b'\x03' * 8, b'\x04' * 8]
+    return bcn
+
+def make_cmd(identifier):
+    cmd = CMD()
+    cmd.identifier = identifier
+    cmd.short_addr = 0x0001
+    return cmd
+
+addr_modes = [MHR.AddrMode.none, MHR.AddrMode.short, MHR.AddrMode.long]
+
+def suite_cases(n=10000):
+    cases = []
+
+    for dst_mode in addr_modes:
+        for src_mode in addr_modes:
+            for panid_compression in (0, 1):
+                if panid_compression and (dst_mode == MHR.AddrMode.none or src_mode == MHR.AddrMode.none):
+                    continue
+                name = '%s-%s%s' % (dst_mode, src_mode, '-compressed' if panid_compression else '')
+                mhr = make_mhr(MHR.FrameType.data, dst_mode, src_mode, panid_compression)
+                packet = mhr.encode() + b'\x07'
+                cases.append(('mhr.decode.' + name, lambda packet=packet: [MHR.decode(packet) for _ in range(n)], n))
+                cases.append(('mhr.encode.' + name, lambda mhr=mhr: [mhr.encode() for _ in range(n)], n))
+
+    for name, bcn in [('plain', make_bcn()), ('gts', make_bcn(gts=True)),
+                      ('pend_addr', make_bcn(pend_addr=True)), ('gts-pend_addr', make_bcn(True, True))]:
+        payload = bcn.encode()
+        cases.append(('bcn.decode.' + name, lambda payload=payload: [BCN.decode(payload) for _ in range(n)], n))
+        cases.append(('bcn.encode.' + name, lambda bcn=bcn: [bcn.encode() for _ in range(n)], n))
+
+    for identifier in CMD.Identifier:
+        payload = make_cmd(identifier).encode()
+        cases.append(('cmd.decode.' + identifier.name, lambda payload=payload: [CMD.decode(payload) for _ in range(n)], n))
+
+    debug_n = n // 10
+    packets = [
+        ('ack', make_mhr(MHR.FrameType.ack, MHR.AddrMode.none, MHR.AddrMode.none).encode()),
+        ('bcn', make_mhr(MHR.FrameType.bcn, MHR.AddrMode.none, MHR.AddrMode.short).encode() + make_bcn(True, True).encode()),
+        ('cmd', make_mhr(MHR.FrameType.cmd, MHR.AddrMode.short, MHR.AddrMode.long, req_ack=1).encode() +
+                make_cmd(CMD.Identifier.association_request).encode()),
+    ]
+    for name, packet in packets:
+        cases.append(('debug_packet.' + name, lambda packet=packet: [debug_packet(packet) for _ in range(debug_n)], debug_n))
+
+    frames = 2 * n
+    stream = make_stream(frames)
+    cases.append(('framing.dev_reader', lambda: dev_reader(stream), frames))
+
+    return cases
+
+def allocations(fn, n):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    stats = after.filter_traces(ignore).compare_to(before.filter_traces(ignore), 'filename')
+    del result
+    return sum(stat.count_diff for stat in stats) / n, sum(stat.size_diff for stat in stats) / n
+
+def bench_suite(names=(), baseline_path='bench_baseline.json', save=False, threshold=None, n=10000):
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    regressions = []
+    print('%-40s %10s %8s %10s %10s %8s' % ('case', 'ns/frame', 'allocs', 'bytes', 'baseline', 'delta'))
+    with open(os.devnull, 'w') as devnull:
+        for name, fn, frames in suite_cases(n):
+            if names and not any(name.startswith(prefix) for prefix in names):
+                continue
+            with redirect_stdout(devnull):
+                elapsed, _ = best_of(fn)
+                blocks, size = allocations(fn, frames)
+            ns = elapsed * 1e9 / frames
+            results[name] = {'ns': round(ns, 1), 'allocs': round(blocks, 2), 'bytes': round(size, 1)}
+
+            line = '%-40s %10.1f %8.2f %10.1f' % (name, ns, blocks, size)
+            if name in baseline:
+                delta = (ns / baseline[name]['ns'] - 1) * 100
+                line += ' %10.1f %+7.1f%%' % (baseline[name]['ns'], delta)
+                if threshold is not None and delta > threshold:
+                    regressions.append(name)
+            print(line)
+
+    if save:
+        baseline.update(results)
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print('saved %d results to %s' % (len(results), baseline_path))
+
+    if regressions:
+        print('%d cases regressed by more than %.0f%%: %s' % (len(regressions), threshold, ', '.join(regressions)))
+    return not regressions
+
+benchmarks = {
+    'framing': bench_framing,
+    'mhr': bench_mhr,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the zag codec and DEV framing.')
+    parser.add_argument('names', nargs='*',
+                        help='comparisons (%s) or suite case prefixes; default runs the suite' % ', '.join(benchmarks))
+    parser.add_argument('--baseline', default='bench_baseline.json', help='stored baseline results')
+    parser.add_argument('--save', action='store_true', help='store the suite results as the new baseline')
+    parser.add_argument('--threshold', type=float,
+                        help='exit non-zero if a case is this many percent slower than its baseline')
+    parser.add_argument('-n', type=int, default=10000, help='frames per case')
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name in benchmarks:
+            print('[%s]' % name)
+            benchmarks[name]()
+    prefixes = [name for name in args.names if name not in benchmarks]
+    if prefixes or not args.names:
+        if not bench_suite(prefixes, args.baseline, args.save, args.threshold, args.n):
+            sys.exit(1)
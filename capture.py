@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+import os
+from queue import Empty, Full, Queue
+import struct
+from threading import Thread
+from time import monotonic, strftime, time_ns
+
+__all__ = ['Capture']
+
+class Capture(object):
+    linktype = 283  # LINKTYPE_IEEE802_15_4_TAP
+
+    inbound = 1
+    outbound = 2
+
+    shb_struct = struct.Struct('<IIIHHqI')
+    idb_struct = struct.Struct('<IIHHIHHB3xHHI')
+    epb_struct = struct.Struct('<IIIIIII')
+    epb_tail_struct = struct.Struct('<HHIHHI')
+    tap_struct = struct.Struct('<BBHHHB3x')
+    tap_rx_struct = struct.Struct('<BBHHHB3xHHfHHB3x')
+
+    def __init__(self, path='capture-%Y%m%d-%H%M%S.pcapng', max_bytes=64 << 20, max_seconds=3600,
+                 queue_size=65536, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_interval = flush_interval
+        self.queue = Queue(queue_size)
+        self.dropped = 0
+        self.file = None
+        self.done = False
+        self.thread = Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def rx(self, packet, rssi, link_quality):
+        self.put((time_ns(), Capture.inbound, packet, rssi, link_quality))
+
+    def tx(self, packet):
+        self.put((time_ns(), Capture.outbound, bytes(packet), None, None))
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        self.done = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def open(self):
+        path = strftime(self.path)
+        n = 1
+        while os.path.exists(path):
+            root, ext = os.path.splitext(strftime(self.path))
+            path = '%s.%d%s' % (root, n, ext)
+            n += 1
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.file_bytes = 0
+        self.file_opened = monotonic()
+
+        self.write_block(Capture.shb_struct.pack(0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+        # if_tsresol = 9: timestamps in nanoseconds
+        self.write_block(Capture.idb_struct.pack(1, 32, Capture.linktype, 0, 0, 9, 1, 9, 0, 0, 32))
+
+    def rotate(self):
+        if self.file is None:
+            self.open()
+        elif self.file_bytes >= self.max_bytes or monotonic() - self.file_opened >= self.max_seconds:
+            self.file.close()
+            self.open()
+
+    def write_block(self, data):
+        self.file.write(data)
+        self.file_bytes += len(data)
+
+    def write_record(self, record):
+        timestamp, direction, packet, rssi, link_quality = record
+        if rssi is None:
+            tap = Capture.tap_struct.pack(0, 0, Capture.tap_struct.size, 0, 1, 0)
+        else:
+            tap = Capture.tap_rx_struct.pack(0, 0, Capture.tap_rx_struct.size, 0, 1, 0,
+                                             1, 4, rssi, 10, 1, link_quality)
+        captured = len(tap) + len(packet)
+        padding = -captured & 3
+        total = Capture.epb_struct.size + captured + padding + Capture.epb_tail_struct.size
+        self.write_block(Capture.epb_struct.pack(6, total, 0, timestamp >> 32, timestamp & 0xFFFFFFFF,
+                                                 captured, captured))
+        self.write_block(tap)
+        self.write_block(packet)
+        self.write_block(bytes(padding))
+        # epb_flags carries the direction, followed by opt_endofopt
+        self.write_block(Capture.epb_tail_struct.pack(2, 4, direction, 0, 0, total))
+
+    def writer(self):
+        last_flush = monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                record = False
+
+            if record is None:
+                break
+            if record:
+                self.rotate()
+                self.write_record(record)
+
+            if self.file and monotonic() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = monotonic()
+
+        if self.file:
+            self.file.close()
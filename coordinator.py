@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 
-from binascii import hexlify, unhexlify
+from beacon import BeaconResponder
+from binascii import hexlify
+from capture import Capture
 from configparser import ConfigParser
+from dedup import DuplicateCache
+import logging
+import metrics
+from packetlog import log_packet, setup_logging
 import sys
 from time import sleep
 from zag import *
-from queue import Queue, Empty
+from queue import Queue
 from random import randint
-from time import time
+from registry import Registry
+from retransmit import Retransmitter
+from scheduler import Scheduler
+from store import Store
+from survey import quietest, survey
+from transfer import Transfers
+import time
+
+log = logging.getLogger('coordinator')
 
 class Coordinator(object):
-    def __init__(self, port):
-        self.dev = DEV(port)
+    def __init__(self, dev):
+        self.dev = dev
         _, self.long_addr = self.dev.get_object(DEV.Param.long_addr, 8)
         print('I\'m %s' % (hexlify(self.long_addr).decode('utf8').upper()),)
 
@@ -19,91 +33,179 @@ class Coordinator(object):
         self.config.optionxform = str
         self.load_config()
 
+        self.capture = None
+        capture = self.config.get('coordinator', 'capture', fallback=None)
+        if capture:
+            self.capture = Capture(capture)
+            for radio in self.dev.radios:
+                radio.capture = self.capture
+
+        self.log_listener = setup_logging(self.config.get('coordinator', 'log_level', fallback='INFO'),
+                                          self.config.get('coordinator', 'log_sample', fallback=''))
+
+        port = self.config.getint('coordinator', 'metrics', fallback=0)
+        if port:
+            metrics.registry.serve(port)
+
         if self.panid == 0xFFFF:
             self.panid = randint(0, 0xFFFD)
             self.save_config()
 
         self.short_addr = 0x0000
+        self.devices.reserve(self.short_addr)
         self.bsn = randint(0, 255)
         self.dsn = randint(0, 255)
+        self.scheduler = Scheduler((DEV.LinkError,))
+        self.retransmitter = Retransmitter(self.dev, self.scheduler)
+        self.duplicates = DuplicateCache()
+        self.transfers = Transfers(self.dev, self.scheduler, self, self.message_handler)
+        self.beacons = BeaconResponder(self.send_bcn, self.scheduler, self.bcn_window, self.bcn_rate, self.bcn_burst)
         self.associate = None
-        self.packet = None
+        self.associate_timer = None
         self.blink = 0
+        self.blink_timer = None
+        self.store_timer = None
+        self.scheduler.call_later(3600, self.compact_store)
 
-        self.dev.set_value(DEV.Param.channel, self.channel)
+        mhr = MHR()
+        mhr.frame_control |= MHR.FrameType.ack << MHR.FrameControl.type
+        self.ack_template = bytearray(mhr.size())
+        mhr.encode_into(self.ack_template)
+
+        if self.channels is None:
+            self.channels = self.select_channels()
+        if len(self.channels) < len(self.dev.radios):
+            raise ValueError('%d radios but only %d channels configured' % (len(self.dev.radios), len(self.channels)))
+        for radio, channel in zip(self.dev.radios, self.channels):
+            radio.set_value(DEV.Param.channel, channel)
         self.dev.set_value(DEV.Param.rx_mode, 0)
         self.dev.set_value(DEV.Param.tx_mode, DEV.TxMode.send_on_cca)
         self.dev.set_leds(0xFF, 0)
 
     def load_config(self):
         self.config.read('coordinator.ini')
-        self.channel = int(self.config.get('coordinator', 'channel', fallback='11'))
+        channel = self.config.get('coordinator', 'channel', fallback='11')
+        self.channels = None if channel.strip() == 'auto' else [int(n) for n in channel.split(',')]
         self.panid = int(self.config.get('coordinator', 'panid', fallback='0xFFFF'), 0)
         self.services = [int(n) for n in self.config.get('coordinator', 'services', fallback='0').split(',')]
         self.services.sort()
         self.ssid = self.config.get('coordinator', 'ssid', fallback='Sample')
-        self.devices = {}
-        if not self.config.has_section('devices'):
-            self.config.add_section('devices')
-        for short_addr, long_addr in self.config.items('devices'):
-            if isinstance(short_addr, str):
-                short_addr = int(short_addr, 0)
-            self.devices[short_addr] = unhexlify(long_addr.encode('utf8'))
+        self.bcn_window = self.config.getfloat('coordinator', 'bcn_window', fallback=0.05)
+        self.bcn_rate = self.config.getfloat('coordinator', 'bcn_rate', fallback=10.0)
+        self.bcn_burst = self.config.getint('coordinator', 'bcn_burst', fallback=3)
+        self.invalidate_templates()
+        self.store = Store(self.config.get('coordinator', 'store', fallback='coordinator.db'))
+        if self.config.has_section('devices'):
+            # Rows added to the INI by hand are merged in; where the two disagree the store wins
+            for short_addr, long_addr in self.store.merge_ini(self.config):
+                log.warning('ignoring [devices] 0x%04X = %s, the store maps it differently',
+                            short_addr, hexlify(long_addr).decode('utf8').upper())
+        self.devices = Registry()
+        self.store.load(self.devices)
+
+    def select_channels(self):
+        n = len(self.dev.radios)
+        max_age = self.config.getfloat('coordinator', 'survey_max_age', fallback=168) * 3600
+        if self.config.has_section('survey'):
+            surveyed = self.config.getfloat('survey', 'time', fallback=0)
+            channels = [int(c) for c in self.config.get('survey', 'channels', fallback='').split(',') if c]
+            if time.time() - surveyed < max_age and len(channels) >= n:
+                log.info('using surveyed channels %s', ','.join(str(c) for c in channels))
+                return channels
+
+        log.info('surveying channels')
+        results = survey(self.dev, samples=self.config.getint('coordinator', 'survey_samples', fallback=128),
+                         threshold=self.config.getint('coordinator', 'survey_threshold', fallback=-75))
+        channels = quietest(results, n)
+        self.config.remove_section('survey')
+        self.config['survey'] = {'time': '%d' % time.time(), 'channels': ','.join(str(c) for c in channels)}
+        for channel, stats in sorted(results.items()):
+            log.info('channel %2d %s', channel, stats.format())
+            self.config['survey']['ch%d' % channel] = stats.format()
+        self.save_config()
+        log.info('selected channels %s', ','.join(str(c) for c in channels))
+        return channels
 
     def save_config(self):
+        self.invalidate_templates()
         self.config['coordinator']['panid'] = '0x%04X' % self.panid
-        for short_addr, long_addr in self.devices.items():
-            self.config['devices']['0x%04X' % short_addr] = hexlify(long_addr).decode('utf8').upper()
         with open('coordinator.ini', 'w') as config_file:
             self.config.write(config_file)
 
+    def store_device(self, short_addr, long_addr, sync=False):
+        self.store.add(short_addr, long_addr)
+        if sync:
+            self.store.flush()
+        elif self.store_timer is None:
+            self.store_timer = self.scheduler.call_later(1, self.flush_store)
+
+    def flush_store(self):
+        self.store.flush()
+        self.store_timer = None
+
+    def compact_store(self):
+        self.store.compact()
+        self.scheduler.call_later(3600, self.compact_store)
+
+    def invalidate_templates(self):
+        self.bcn_template = None
+        self.assoc_template = None
+
     def wait_associate(self, src_addr):
-        self.associate_start = time()
+        if self.associate_timer:
+            self.associate_timer.cancel()
         self.associate = src_addr
+        self.associate_timer = self.scheduler.call_later(30, self.associate_timeout)
         self.start_blink(DEV.Leds.green)
 
+    def associate_timeout(self):
+        long_addr, self.associate = self.associate, None
+        self.associate_timer = None
+        self.end_blink(DEV.Leds.green)
+        self.send_association_response(long_addr, True)
+
     def start_blink(self, leds):
-        self.dev.set_leds(leds, leds)
         self.blink |= leds
-        self.blink_last = time()
+        if self.blink_timer is None:
+            self.blink_timer = self.scheduler.call_later(0.25, self.blink_handler)
+        self.dev.set_leds(leds, leds)
 
     def end_blink(self, leds):
-        self.dev.set_leds(leds, ~leds)
         self.blink &= ~leds
+        if not self.blink and self.blink_timer:
+            self.blink_timer.cancel()
+            self.blink_timer = None
+        self.dev.set_leds(leds, ~leds)
 
-    def send_packet_wait_ack(self, packet):
-        self.packet = packet
-        self.packet_last = time()
-        self.packet_retry = 0
-        self.packet_seq = self.dsn
-        self.dev.send_packet(packet)
+    def blink_handler(self):
+        self.blink_timer = self.scheduler.call_later(0.25, self.blink_handler)
+        self.dev.set_leds(self.blink, self.dev.get_leds() ^ self.blink)
 
     def send_ack(self, seq_num):
-        mhr = MHR()
-        mhr.frame_control |= MHR.FrameType.ack << MHR.FrameControl.type
-        mhr.seq_num = seq_num
-        packet = mhr.encode()
-        self.dev.send_packet(packet)
-
-    def send_bcn(self):
-        mhr = MHR()
-        mhr.frame_control |= MHR.FrameType.bcn << MHR.FrameControl.type
-        mhr.frame_control |= MHR.AddrMode.short << MHR.FrameControl.src_mode
-        mhr.seq_num = self.bsn
-        mhr.src_panid = self.panid
-        mhr.src_addr = self.short_addr
-        packet = mhr.encode()
-
-        bcn = BCN()
-        bcn.superframe |= 15 << BCN.Superframe.bcn_order
-        bcn.superframe |= 15 << BCN.Superframe.superframe_order
-        bcn.superframe |= 1 << BCN.Superframe.pan_coordinator
-        bcn.superframe |= 1 << BCN.Superframe.association_permit
-        bcn.ssid = self.ssid
-        bcn.services = self.services
-        packet += bcn.encode()
-
-        self.dev.send_packet(packet)
+        self.ack_template[MHR.seq_num_offset] = seq_num
+        self.dev.send_packet(self.ack_template)
+
+    def send_bcn(self, radio=None):
+        if self.bcn_template is None:
+            mhr = MHR()
+            mhr.frame_control |= MHR.FrameType.bcn << MHR.FrameControl.type
+            mhr.frame_control |= MHR.AddrMode.short << MHR.FrameControl.src_mode
+            mhr.src_panid = self.panid
+            mhr.src_addr = self.short_addr
+
+            bcn = BCN()
+            bcn.superframe |= 15 << BCN.Superframe.bcn_order
+            bcn.superframe |= 15 << BCN.Superframe.superframe_order
+            bcn.superframe |= 1 << BCN.Superframe.pan_coordinator
+            bcn.superframe |= 1 << BCN.Superframe.association_permit
+            bcn.ssid = self.ssid
+            bcn.services = self.services
+
+            self.bcn_template = bytearray(mhr.size() + bcn.size())
+            bcn.encode_into(self.bcn_template, mhr.encode_into(self.bcn_template))
+
+        self.bcn_template[MHR.seq_num_offset] = self.bsn
+        (radio or self.dev).send_packet(self.bcn_template)
         self.bsn = (self.bsn + 1) & 0xFF
 
     def send_association_response(self, long_addr, access_denied=False):
@@ -111,47 +213,51 @@ class Coordinator(object):
         if access_denied:
             status = CMD.AssocStatus.access_denied
         else:
-            for short, long in self.devices.items():
-                if long == long_addr:
-                    short_addr = short
-
             status = CMD.AssocStatus.assoc_success
-            if short_addr > 0xFFFD:
-                if len(self.devices) >= 0xFFFD:
-                    short_addr == 0xFFFF
+            short_addr = self.devices.lookup(long_addr)
+            if short_addr is None:
+                short_addr = self.devices.allocate(long_addr)
+                if short_addr is None:
+                    short_addr = 0xFFFF
                     status = CMD.AssocStatus.pan_at_capacity
                 else:
-                    while True:
-                        short_addr = randint(0, 0xFFFD)
-                        if short_addr == self.short_addr:
-                            continue
-                        if short_addr not in self.devices:
-                            break
-                    self.devices[short_addr] = long_addr
-                    self.save_config()
-
-        mhr = MHR()
-        mhr.frame_control |= MHR.FrameType.cmd << MHR.FrameControl.type
-        mhr.frame_control |= 1 << MHR.FrameControl.req_ack
-        mhr.frame_control |= 1 << MHR.FrameControl.panid_compression
-        mhr.frame_control |= MHR.AddrMode.long << MHR.FrameControl.dst_mode
-        mhr.frame_control |= MHR.AddrMode.long << MHR.FrameControl.src_mode
-        mhr.seq_num = self.dsn
-        mhr.dst_panid = self.panid
-        mhr.dst_addr = long_addr
-        mhr.src_panid = self.panid
-        mhr.src_addr = self.long_addr
-        packet = mhr.encode()
-        
-        cmd = CMD()
-        cmd.identifier = CMD.Identifier.association_response
-        cmd.short_addr = short_addr
-        cmd.status = status
-        packet += cmd.encode()
-
-        self.send_packet_wait_ack(packet)
+                    # Commit before the address goes out on air so a crash cannot hand it out twice
+                    self.store_device(short_addr, long_addr, True)
+
+        if self.assoc_template is None:
+            mhr = MHR()
+            mhr.frame_control |= MHR.FrameType.cmd << MHR.FrameControl.type
+            mhr.frame_control |= 1 << MHR.FrameControl.req_ack
+            mhr.frame_control |= 1 << MHR.FrameControl.panid_compression
+            mhr.frame_control |= MHR.AddrMode.long << MHR.FrameControl.dst_mode
+            mhr.frame_control |= MHR.AddrMode.long << MHR.FrameControl.src_mode
+            mhr.dst_panid = self.panid
+            mhr.src_panid = self.panid
+            mhr.src_addr = self.long_addr
+
+            cmd = CMD()
+            cmd.identifier = CMD.Identifier.association_response
+
+            self.assoc_mhr = mhr
+            self.assoc_cmd = cmd
+            self.assoc_template = bytearray(mhr.size() + cmd.size())
+
+        self.assoc_mhr.seq_num = self.dsn
+        self.assoc_mhr.dst_addr = long_addr
+        self.assoc_cmd.short_addr = short_addr
+        self.assoc_cmd.status = status
+        self.assoc_cmd.encode_into(self.assoc_template, self.assoc_mhr.encode_into(self.assoc_template))
+
+        self.retransmitter.send(long_addr, self.dsn, self.assoc_template,
+                                self.association_complete, self.association_failed)
         self.dsn = (self.dsn + 1) & 0xFF
 
+    def association_complete(self, long_addr):
+        log.info('%s acknowledged association response', hexlify(long_addr).decode('utf8').upper())
+
+    def association_failed(self, long_addr):
+        log.warning('%s did not acknowledge association response', hexlify(long_addr).decode('utf8').upper())
+
     def bcn_request_handler(self, mhr, cmd):
         if mhr.frame_control >> MHR.FrameControl.src_mode & 0x3 != MHR.AddrMode.none:
             return
@@ -161,7 +267,7 @@ class Coordinator(object):
             return
         if mhr.dst_addr != 0xFFFF:
             return
-        self.send_bcn()
+        self.beacons.request(self.dev.current)
 
     def association_request_handler(self, mhr, cmd):
         if not mhr.frame_control & (1 << MHR.FrameControl.req_ack):
@@ -182,71 +288,77 @@ class Coordinator(object):
             self.send_association_response(mhr.src_addr, True)
             return
 
-        if mhr.src_addr in self.devices.values():
+        if self.devices.lookup(mhr.src_addr) is not None:
             self.send_association_response(mhr.src_addr)
         else:
             self.wait_associate(mhr.src_addr)
 
+    def duplicate(self, mhr):
+        if not mhr.supported or not self.duplicates.seen(mhr):
+            return False
+        if mhr.frame_control & (1 << MHR.FrameControl.req_ack):
+            if DuplicateCache.addressed_to(mhr, self.panid, self.short_addr, self.long_addr):
+                self.send_ack(mhr.seq_num)
+        return True
+
+    def message_handler(self, src_addr, message):
+        log.info('received %d byte message from 0x%04X', len(message), src_addr)
+
     def cmd_handler(self, mhr, cmd, payload):
         if cmd.identifier == CMD.Identifier.bcn_request:
             self.bcn_request_handler(mhr, cmd)
         elif cmd.identifier == CMD.Identifier.association_request:
             self.association_request_handler(mhr, cmd)
 
-    def packet_handler(self, packet, rssi):
-        debug_packet(packet)
-
-        mhr, payload = MHR.decode(packet)
-        if mhr.frame_control & 0x7 == MHR.FrameType.ack:
-            if self.packet and mhr.seq_num == self.packet_seq:
-                self.packet = None
-                self.packet_retry = 0
-        elif mhr.frame_control & 0x7 == MHR.FrameType.cmd:
-            cmd, payload = CMD.decode(payload)
-            self.cmd_handler(mhr, cmd, payload)
+    def packet_handler(self, packet, rssi, link_quality):
+        mhr = MHR.View(packet)
+        if mhr.frame_type == MHR.FrameType.ack:
+            log_packet(mhr, None, rssi, link_quality)
+            self.retransmitter.ack(mhr.seq_num)
+        elif mhr.frame_type == MHR.FrameType.data and mhr.supported:
+            log_packet(mhr, None, rssi, link_quality)
+            self.transfers.packet_handler(mhr)
+        elif self.duplicate(mhr):
+            log_packet(mhr, None, rssi, link_quality)
+        elif mhr.frame_type == MHR.FrameType.cmd and mhr.supported:
+            cmd = CMD.View(mhr.payload)
+            log_packet(mhr, cmd, rssi, link_quality)
+            self.cmd_handler(mhr, cmd, cmd.payload)
+        else:
+            log_packet(mhr, None, rssi, link_quality)
 
     def button_handler(self, button):
         if button == 1:
             if self.associate != None:
-                self.send_association_response(self.associate)
-                self.associate = None
+                self.associate_timer.cancel()
+                self.associate_timer = None
+                long_addr, self.associate = self.associate, None
                 self.end_blink(DEV.Leds.green)
+                self.send_association_response(long_addr)
 
     def loop(self):
+        handlers = {
+            DEV.Event.on_packet: self.packet_handler,
+            DEV.Event.on_button: self.button_handler,
+        }
         try:
             while True:
                 try:
-                    event, data = self.dev.event_queue.get(timeout=0.25)
-                    if event == DEV.Event.on_packet:
-                        self.packet_handler(*data)
-                    elif event == DEV.Event.on_button:
-                        self.button_handler(*data)
-                except Empty:
-                    pass
-
-                now = time()
-
-                if self.associate and self.associate_start + 30 <= now:
-                    self.send_association_response(self.associate, True)
-                    self.associate = None
-                    self.end_blink(DEV.Leds.green)
-
-                if self.blink and self.blink_last + 0.25 <= now:
-                    self.blink_last = now
-                    self.dev.set_leds(self.blink, self.dev.get_leds() ^ self.blink)
-
-                if self.packet and self.packet_last + 0.25 <= now:
-                    self.packet_last = now
-                    if self.packet_retry < 10:
-                        self.dev.send_packet(self.packet)
-                        self.packet_retry += 1
-                    else:
-                        self.packet = None
-
+                    self.scheduler.run(self.dev.event_queue, handlers)
+                except DEV.LinkError as e:
+                    log.warning('radio link error: %s', e)
         except KeyboardInterrupt:
+            if self.capture:
+                self.capture.close()
+            self.log_listener.stop()
+            self.store.close()
             self.dev.shutdown()
 
 
 if __name__ == '__main__':
-    coordinator = Coordinator(sys.argv[1])
+    if len(sys.argv) > 2:
+        dev = DEVGroup(sys.argv[1:])
+    else:
+        dev = DEV(sys.argv[1])
+    coordinator = Coordinator(dev)
     coordinator.loop()
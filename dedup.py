@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import metrics
+from time import monotonic
+from zag import MHR
+
+__all__ = ['DuplicateCache']
+
+class DuplicateCache(object):
+    duplicates = metrics.registry.counter('zag_duplicate_frames_total', 'Received frames suppressed as duplicates')
+
+    def __init__(self, size=1024, ttl=5.0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(mhr):
+        if 'src_addr' not in mhr.layout.offsets:
+            return None
+        return mhr.src_addr, mhr.seq_num, mhr.frame_type
+
+    @staticmethod
+    def addressed_to(mhr, panid, short_addr, long_addr):
+        dst_mode = (mhr.frame_control >> MHR.FrameControl.dst_mode) & 0x3
+        if dst_mode == MHR.AddrMode.short:
+            return mhr.dst_panid in (panid, 0xFFFF) and mhr.dst_addr == short_addr
+        if dst_mode == MHR.AddrMode.long:
+            return mhr.dst_addr == long_addr
+        return False
+
+    def expire(self, now):
+        entries = self.entries
+        while entries:
+            key, seen = next(iter(entries.items()))
+            if now - seen < self.ttl:
+                break
+            entries.popitem(last=False)
+            self.expired += 1
+
+    def seen(self, mhr):
+        key = DuplicateCache.key(mhr)
+        if key is None:
+            return False
+        now = monotonic()
+        self.expire(now)
+        if key in self.entries:
+            self.hits += 1
+            DuplicateCache.duplicates.inc()
+            return True
+        self.entries[key] = now
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+        self.misses += 1
+        return False
+
+    def clear(self):
+        self.entries.clear()
@@ -1,23 +1,33 @@
 #!/usr/bin/env python3
 
 from binascii import hexlify, unhexlify
+from capture import Capture
 from configparser import ConfigParser
+from dedup import DuplicateCache
 from enum import IntEnum, unique
+import logging
+import metrics
+from packetlog import log_packet, setup_logging
 import sys
 from time import sleep
-from queue import Queue, Empty
+from queue import Queue
 from random import randint
-from time import time
+from retransmit import Retransmitter
+from scan import Scanner
+from scheduler import Scheduler
+from transfer import Transfers
 from zag import *
 
+log = logging.getLogger('device')
+
 class Device(object):
     @unique
     class AssocState(IntEnum):
         idle = 0
         wait_response = 1
 
-    def __init__(self, port):
-        self.dev = DEV(port)
+    def __init__(self, dev):
+        self.dev = dev
         _, self.long_addr = self.dev.get_object(DEV.Param.long_addr, 8)
         print('I\'m %s' % (hexlify(self.long_addr).decode('utf8').upper()),)
 
@@ -25,8 +35,32 @@ class Device(object):
         self.config.optionxform = str
         self.load_config()
 
+        self.capture = None
+        capture = self.config.get('device', 'capture', fallback=None)
+        if capture:
+            self.capture = Capture(capture)
+            for radio in self.dev.radios:
+                radio.capture = self.capture
+
+        self.log_listener = setup_logging(self.config.get('device', 'log_level', fallback='INFO'),
+                                          self.config.get('device', 'log_sample', fallback=''))
+
+        port = self.config.getint('device', 'metrics', fallback=0)
+        if port:
+            metrics.registry.serve(port)
+
+        self.scheduler = Scheduler((DEV.LinkError,))
+        self.retransmitter = Retransmitter(self.dev, self.scheduler)
+        self.duplicates = DuplicateCache()
+        self.transfers = Transfers(self.dev, self.scheduler, self, self.message_handler)
+        self.scanner = Scanner(self.dev, self.scheduler, self.beacon_request)
         self.dsn = randint(0, 255)
-        self.packet = None
+        self.assoc_timer = None
+
+        mhr = MHR()
+        mhr.frame_control |= MHR.FrameType.ack << MHR.FrameControl.type
+        self.ack_template = bytearray(mhr.size())
+        mhr.encode_into(self.ack_template)
         self.assoc_state = Device.AssocState.idle
 
         self.dev.set_value(DEV.Param.channel, self.channel)
@@ -38,33 +72,26 @@ class Device(object):
         self.config.read('device.ini')
         self.channel = int(self.config.get('device', 'channel', fallback='11'))
         self.panid = int(self.config.get('device', 'panid', fallback='0xFFFF'), 0)
+        self.short_addr = int(self.config.get('device', 'short_addr', fallback='0xFFFE'), 0)
         coordinator = self.config.get('device', 'coordinator', fallback='')
         self.coordinator = unhexlify(coordinator.encode('utf8'))
         self.service = int(self.config.get('device', 'service', fallback=-1), 0)
         self.ssid = self.config.get('device', 'ssid', fallback=None)
+        self.scan_dwell = self.config.getfloat('device', 'scan_dwell', fallback=0.25)
 
     def save_config(self):
+        self.config['device']['channel'] = str(self.channel)
         self.config['device']['coordinator'] =  hexlify(self.coordinator).decode('utf8').upper()
         self.config['device']['panid'] = '0x%04X' % self.panid
         self.config['device']['short_addr'] = '0x%04X' % self.short_addr
         with open('device.ini', 'w') as config_file:
             self.config.write(config_file)
 
-    def send_packet_wait_ack(self, packet):
-        self.packet = packet
-        self.packet_last = time()
-        self.packet_retry = 0
-        self.packet_seq = self.dsn
-        self.dev.send_packet(packet)
-
     def send_ack(self, seq_num):
-        mhr = MHR()
-        mhr.frame_control |= MHR.FrameType.ack << MHR.FrameControl.type
-        mhr.seq_num = seq_num
-        packet = mhr.encode()
-        self.dev.send_packet(packet)
+        self.ack_template[MHR.seq_num_offset] = seq_num
+        self.dev.send_packet(self.ack_template)
 
-    def send_beacon_request(self):
+    def beacon_request(self):
         mhr = MHR()
         mhr.frame_control |= MHR.FrameType.cmd << MHR.FrameControl.type
         mhr.frame_control |= MHR.AddrMode.short << MHR.FrameControl.dst_mode
@@ -77,12 +104,17 @@ class Device(object):
         cmd.identifier = CMD.Identifier.bcn_request
         packet += cmd.encode()
 
-        self.dev.send_packet(packet)
         self.dsn = (self.dsn + 1) & 0xFF
+        return packet
+
+    def send_beacon_request(self):
+        self.dev.send_packet(self.beacon_request())
 
     def send_assoc_request(self, panid, short_addr):
         self.assoc_state = Device.AssocState.wait_response
-        self.assoc_start = time()
+        if self.assoc_timer:
+            self.assoc_timer.cancel()
+        self.assoc_timer = self.scheduler.call_later(35, self.assoc_timeout)
 
         mhr = MHR()
         mhr.frame_control |= MHR.FrameType.cmd << MHR.FrameControl.type
@@ -93,7 +125,7 @@ class Device(object):
         mhr.dst_panid = panid
         mhr.dst_addr = short_addr
         mhr.src_panid = 0xFFFF
-        _, mhr.src_addr = self.dev.get_object(DEV.Param.long_addr, 8)
+        mhr.src_addr = self.long_addr
         packet = mhr.encode()
 
         cmd = CMD()
@@ -103,10 +135,19 @@ class Device(object):
         cmd.capability |= 1 << CMD.AssocCapability.allocate_address
         packet += cmd.encode()
 
-        self.send_packet_wait_ack(packet)
+        self.retransmitter.send((panid, short_addr), self.dsn, packet, on_failure=self.assoc_failed)
         self.dsn = (self.dsn + 1) & 0xFF
 
-    def bcn_handler(self, mhr, bcn, payload):
+    def assoc_timeout(self):
+        self.assoc_state = Device.AssocState.idle
+        self.assoc_timer = None
+
+    def assoc_failed(self, coordinator):
+        if self.assoc_state == Device.AssocState.wait_response:
+            self.assoc_timer.cancel()
+            self.assoc_timeout()
+
+    def bcn_handler(self, mhr, bcn, payload, rssi, link_quality):
         if mhr.frame_control >> MHR.FrameControl.src_mode & 0x3 != MHR.AddrMode.short:
             return
         if mhr.frame_control >> MHR.FrameControl.dst_mode & 0x3 != MHR.AddrMode.none:
@@ -119,6 +160,9 @@ class Device(object):
             return
         if not bcn.superframe & BCN.Superframe.association_permit:
             return
+        if self.scanner.active:
+            self.scanner.beacon(self.dev.current, mhr, bcn, rssi, link_quality)
+            return
         if self.ssid != None and self.ssid != bcn.ssid:
             return
         if self.service not in bcn.services:
@@ -142,59 +186,87 @@ class Device(object):
         self.short_addr = cmd.short_addr
         self.save_config()
         self.assoc_state = Device.AssocState.idle
+        self.assoc_timer.cancel()
+        self.assoc_timer = None
+
+    def duplicate(self, mhr):
+        if not mhr.supported or not self.duplicates.seen(mhr):
+            return False
+        if mhr.frame_control & (1 << MHR.FrameControl.req_ack):
+            if DuplicateCache.addressed_to(mhr, self.panid, self.short_addr, self.long_addr):
+                self.send_ack(mhr.seq_num)
+        return True
+
+    def message_handler(self, src_addr, message):
+        log.info('received %d byte message from 0x%04X', len(message), src_addr)
 
     def cmd_handler(self, mhr, cmd, payload):
         if cmd.identifier == CMD.Identifier.association_response:
             self.association_response_handler(mhr, cmd)
 
-    def packet_handler(self, packet, rssi):
-        debug_packet(packet)
-
-        mhr, payload = MHR.decode(packet)
-        if mhr.frame_control & 0x7 == MHR.FrameType.ack:
-            if self.packet and mhr.seq_num == self.packet_seq:
-                self.packet = None
-                self.packet_retry = 0
-        elif mhr.frame_control & 0x7 == MHR.FrameType.bcn:
-            bcn, payload = BCN.decode(payload)
-            self.bcn_handler(mhr, bcn, payload)
-        elif mhr.frame_control & 0x7 == MHR.FrameType.cmd:
-            cmd, payload = CMD.decode(payload)
-            self.cmd_handler(mhr, cmd, payload)            
+    def packet_handler(self, packet, rssi, link_quality):
+        mhr = MHR.View(packet)
+        if mhr.frame_type == MHR.FrameType.ack:
+            log_packet(mhr, None, rssi, link_quality)
+            self.retransmitter.ack(mhr.seq_num)
+        elif mhr.frame_type == MHR.FrameType.data and mhr.supported:
+            log_packet(mhr, None, rssi, link_quality)
+            self.transfers.packet_handler(mhr)
+        elif self.duplicate(mhr):
+            log_packet(mhr, None, rssi, link_quality)
+        elif mhr.frame_type == MHR.FrameType.bcn and mhr.supported:
+            bcn = BCN.View(mhr.payload)
+            log_packet(mhr, bcn, rssi, link_quality)
+            self.bcn_handler(mhr, bcn, bcn.payload, rssi, link_quality)
+        elif mhr.frame_type == MHR.FrameType.cmd and mhr.supported:
+            cmd = CMD.View(mhr.payload)
+            log_packet(mhr, cmd, rssi, link_quality)
+            self.cmd_handler(mhr, cmd, cmd.payload)
+        else:
+            log_packet(mhr, None, rssi, link_quality)
 
     def button_handler(self, button):
         if button == 1:
-            self.send_beacon_request()
+            if self.scan_dwell > 0:
+                self.scanner.start(self.scan_dwell, self.scan_complete, self.ssid, self.service)
+            else:
+                self.send_beacon_request()
+
+    def scan_complete(self, candidates):
+        for candidate in candidates:
+            log.info('scan found %r', candidate)
+        best = next((candidate for candidate in candidates if candidate.matches(self.ssid, self.service)), None)
+        if best is None:
+            log.warning('scan found no coordinator to join')
+            self.dev.set_value(DEV.Param.channel, self.channel)
+            return
+        self.channel = best.channel
+        self.dev.set_value(DEV.Param.channel, self.channel)
+        self.send_assoc_request(best.panid, best.short_addr)
 
     def loop(self):
+        handlers = {
+            DEV.Event.on_packet: self.packet_handler,
+            DEV.Event.on_button: self.button_handler,
+            Scanner.event: self.scanner.tuned_handler,
+        }
         try:
             while True:
                 try:
-                    event, data = self.dev.event_queue.get(timeout=0.25)
-                    if event == DEV.Event.on_packet:
-                        self.packet_handler(*data)
-                    elif event == DEV.Event.on_button:
-                        self.button_handler(*data)
-                except Empty:
-                    pass
-
-                now = time()
-
-                if self.packet and self.packet_last + 0.25 <= now:
-                    self.packet_last = now
-                    if self.packet_retry < 10:
-                        self.dev.send_packet(self.packet)
-                        self.packet_retry += 1
-                    else:
-                        self.packet = None
-
-                if self.assoc_state and self.assoc_start + 35 <= now:
-                    self.assoc_state = Device.AssocState.idle
-
+                    self.scheduler.run(self.dev.event_queue, handlers)
+                except DEV.LinkError as e:
+                    log.warning('radio link error: %s', e)
         except KeyboardInterrupt:
+            if self.capture:
+                self.capture.close()
+            self.log_listener.stop()
             self.dev.shutdown()
 
 
 if __name__ == '__main__':
-    coordinator = Device(sys.argv[1])
-    coordinator.loop()
+    if len(sys.argv) > 2:
+        dev = DEVGroup(sys.argv[1:])
+    else:
+        dev = DEV(sys.argv[1])
+    device = Device(dev)
+    device.loop()
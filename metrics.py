@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry']
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    values = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for name, value in zip(names, values))
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+        self.callbacks = {}
+
+    def track(self, labels, fn):
+        self.callbacks[tuple(labels)] = fn
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, fn in list(self.callbacks.items()):
+            values.append((labels, fn()))
+        for labels, value in sorted(values, key=lambda item: item[0]):
+            yield self.name, self.labels, labels, value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        for name, label_names, labels, value in self.samples():
+            lines.append('%s%s %s' % (name, format_labels(label_names, labels), format_value(value)))
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + 1
+
+    def add(self, n, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+class Histogram(Metric):
+    type = 'histogram'
+    buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        Metric.__init__(self, name, help, labels)
+        self.bounds = tuple(buckets or Histogram.buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.bounds) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(series)) for labels, series in self.values.items()]
+        bucket_labels = self.labels + ('le',)
+        for labels, series in sorted(values, key=lambda item: item[0]):
+            total = 0
+            for bound, n in zip(self.bounds + (float('inf'),), series):
+                total += n
+                yield self.name + '_bucket', bucket_labels, labels + (format_value(bound),), total
+            yield self.name + '_sum', self.labels, labels, series[-1]
+            yield self.name + '_count', self.labels, labels, total
+
+class Registry(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+        self.server = None
+
+    def register(self, cls, name, help, labels=(), **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('%s is already registered as a %s' % (name, metric.type))
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def shutdown(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+registry = Registry()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+import struct
+import sys
+from zag import MHR, format_fields
+
+__all__ = ['PacketMessage', 'FrameSampler', 'DroppingQueueHandler', 'log_packet', 'setup_logging']
+
+logger = logging.getLogger('zag.packet')
+
+class PacketMessage(object):
+    __slots__ = ('mhr', 'body', 'rssi', 'link_quality')
+
+    def __init__(self, mhr, body, rssi, link_quality):
+        self.mhr = mhr
+        self.body = body
+        self.rssi = rssi
+        self.link_quality = link_quality
+
+    def __str__(self):
+        mhr = self.mhr
+        try:
+            frame_type = str(MHR.FrameType(mhr.frame_type))
+        except ValueError:
+            frame_type = str(mhr.frame_type)
+        s = '%s rssi:%d lqi:%d' % (frame_type, self.rssi, self.link_quality)
+        if not mhr.supported:
+            return s + ' unsupported frame_control:0x%04X data:%s' % (mhr.frame_control, bytes(mhr.data).hex())
+        payload = mhr.payload
+        try:
+            s += ' mhr(%s)' % format_fields(mhr, mhr.fields)
+            if self.body is not None:
+                s += ' %s(%s)' % (frame_type, format_fields(self.body, self.body.fields))
+                payload = self.body.payload
+        except (ValueError, IndexError, struct.error):
+            s += ' malformed'
+        if payload:
+            s += ' payload:%s' % bytes(payload).hex()
+        return s
+
+class FrameSampler(logging.Filter):
+    def __init__(self, rates):
+        logging.Filter.__init__(self)
+        self.rates = rates
+        self.counts = {}
+
+    @staticmethod
+    def parse(spec):
+        rates = {}
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            name, rate = item.split(':')
+            rates[MHR.FrameType[name.strip()]] = int(rate)
+        return rates
+
+    def filter(self, record):
+        frame_type = getattr(record, 'frame_type', None)
+        rate = self.rates.get(frame_type, 1)
+        if rate <= 1:
+            return True
+        n = self.counts.get(frame_type, 0)
+        self.counts[frame_type] = n + 1
+        return n % rate == 0
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+def log_packet(mhr, body, rssi, link_quality):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s', PacketMessage(mhr, body, rssi, link_quality), extra={'frame_type': mhr.frame_type})
+
+def setup_logging(level='INFO', sample='', stream=None, queue_size=4096):
+    root = logging.getLogger()
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for handler in root.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            return handler.listener
+
+    queue = Queue(queue_size)
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    queue_handler = DroppingQueueHandler(queue)
+    queue_handler.listener = QueueListener(queue, handler)
+    root.addHandler(queue_handler)
+    if sample:
+        logger.addFilter(FrameSampler(FrameSampler.parse(sample)))
+    queue_handler.listener.start()
+    return queue_handler.listener
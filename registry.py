@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+__all__ = ['Registry']
+
+class Registry(object):
+    capacity = 0xFFFE
+
+    free = 0
+    allocated = 1
+    reserved = 2
+
+    def __init__(self):
+        self.slots = bytearray(8 * Registry.capacity)
+        self.state = bytearray(Registry.capacity)
+        self.index = {}
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, short_addr):
+        return 0 <= short_addr < Registry.capacity and self.state[short_addr] == Registry.allocated
+
+    def __iter__(self):
+        return iter(sorted(self.index.values()))
+
+    def items(self):
+        for short_addr in self:
+            yield short_addr, self.get(short_addr)
+
+    def get(self, short_addr, default=None):
+        if short_addr not in self:
+            return default
+        return bytes(self.slots[8 * short_addr:8 * short_addr + 8])
+
+    def lookup(self, long_addr, default=None):
+        return self.index.get(int.from_bytes(long_addr, 'big'), default)
+
+    def reserve(self, short_addr):
+        if short_addr in self:
+            self.remove(short_addr)
+        self.state[short_addr] = Registry.reserved
+
+    def add(self, short_addr, long_addr):
+        if not 0 <= short_addr < Registry.capacity:
+            raise ValueError('invalid short address 0x%04X' % short_addr)
+        if len(long_addr) != 8:
+            raise ValueError('long address must be 8 bytes')
+        if short_addr in self:
+            self.remove(short_addr)
+        previous = self.lookup(long_addr)
+        if previous is not None:
+            self.remove(previous)
+        self.slots[8 * short_addr:8 * short_addr + 8] = long_addr
+        self.state[short_addr] = Registry.allocated
+        self.index[int.from_bytes(long_addr, 'big')] = short_addr
+
+    def remove(self, short_addr):
+        long_addr = self.get(short_addr)
+        if long_addr is None:
+            return None
+        del self.index[int.from_bytes(long_addr, 'big')]
+        self.state[short_addr] = Registry.free
+        return long_addr
+
+    def allocate(self, long_addr):
+        short_addr = self.lookup(long_addr)
+        if short_addr is not None:
+            return short_addr
+
+        short_addr = self.state.find(Registry.free, self.cursor)
+        if short_addr < 0:
+            short_addr = self.state.find(Registry.free, 0, self.cursor)
+        if short_addr < 0:
+            return None
+
+        self.add(short_addr, long_addr)
+        self.cursor = short_addr + 1
+        return short_addr
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import argparse
+from binascii import unhexlify
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import redirect_stdout
+from coordinator import Coordinator
+from device import Device
+import json
+import os
+from queue import Queue
+import shutil
+import struct
+import tempfile
+from time import monotonic, perf_counter, sleep
+from zag import *
+
+__all__ = ['ReplayDEV', 'ReplayClock', 'read_pcap', 'read_pcapng', 'read_jsonl', 'read_records', 'replay']
+
+class ReplayDEV(object):
+    def __init__(self, long_addr=b'\x00' * 8):
+        self.long_addr = long_addr
+        self.values = {DEV.Param.channel_min: 11, DEV.Param.channel_max: 26, DEV.Param.rssi: -95 & 0xFFFF}
+        self.leds = 0
+        self.sent = []
+        self.event_queue = Queue()
+        self.capture = None
+
+    @property
+    def radios(self):
+        return [self]
+
+    @property
+    def current(self):
+        return self
+
+    @staticmethod
+    def result(value, block):
+        if block:
+            return value
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def shutdown(self):
+        pass
+
+    def send_packet(self, data, block=True):
+        self.sent.append(bytes(data))
+        return self.result((DEV.TransmitResult.ok,), block)
+
+    def get_mem(self, addr, n=1, reverse=False, block=True):
+        return self.result(0 if n == 1 else bytes(n), block)
+
+    def set_mem(self, addr, data, reverse=False, block=True):
+        return self.result(None, block)
+
+    def get_value(self, param, block=True):
+        return self.result((DEV.Result.ok, self.values.get(param, 0)), block)
+
+    def set_value(self, param, value, block=True):
+        self.values[param] = value
+        return self.result((DEV.Result.ok,), block)
+
+    def get_object(self, param, expected_len, block=True):
+        if param == DEV.Param.long_addr:
+            return self.result((DEV.Result.ok, self.long_addr), block)
+        return self.result((DEV.Result.not_supported, b''), block)
+
+    def set_object(self, param, data, block=True):
+        return self.result((DEV.Result.ok,), block)
+
+    def get_leds(self, block=True):
+        return self.result(self.leds, block)
+
+    def set_leds(self, mask, values, block=True):
+        self.leds = (self.leds & ~mask) | (values & mask)
+        return self.result(True, block)
+
+class ReplayClock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, scheduler, until):
+        # Fire due timers one deadline at a time, so anything they schedule is timed as it would be live
+        while True:
+            timeout = scheduler.timeout()
+            if timeout is None or self.now + timeout > until:
+                break
+            self.now += timeout
+            scheduler.run_timers()
+        self.now = max(self.now, until)
+
+def read_pcap(f):
+    header = f.read(24)
+    magic, = struct.unpack_from('<I', header)
+    endian = '<' if magic in (0xA1B2C3D4, 0xA1B23C4D) else '>'
+    scale = 1e-9 if magic in (0xA1B23C4D, 0x4D3CB2A1) else 1e-6
+    linktype, = struct.unpack_from(endian + 'I', header, 20)
+    while True:
+        record = f.read(16)
+        if len(record) < 16:
+            return
+        seconds, fraction, captured, _ = struct.unpack(endian + 'IIII', record)
+        data = f.read(captured)
+        if linktype == 195:
+            data = data[:-2]
+        yield seconds + fraction * scale, data, 0, 0
+
+def parse_tap(data):
+    rssi, link_quality = 0, 0
+    length, = struct.unpack_from('<H', data, 2)
+    offset = 4
+    while offset + 4 <= length:
+        tlv_type, tlv_len = struct.unpack_from('<HH', data, offset)
+        if tlv_type == 1:
+            rssi = int(round(struct.unpack_from('<f', data, offset + 4)[0]))
+        elif tlv_type == 10:
+            link_quality = data[offset + 4]
+        offset += 4 + tlv_len + (-tlv_len & 3)
+    return data[length:], rssi, link_quality
+
+def read_pcapng(f):
+    endian = '<'
+    interfaces = []
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        block_type, = struct.unpack_from('<I', header)
+        if block_type == 0x0A0D0D0A:
+            magic, = struct.unpack_from('<I', f.read(4))
+            endian = '<' if magic == 0x1A2B3C4D else '>'
+            interfaces = []
+            length, = struct.unpack_from(endian + 'I', header, 4)
+            body = f.read(length - 12)
+            continue
+
+        length, = struct.unpack_from(endian + 'I', header, 4)
+        body = f.read(length - 8)
+        if block_type == 1:
+            linktype, = struct.unpack_from(endian + 'H', body)
+            resolution = 1e-6
+            offset = 8
+            while offset + 4 <= len(body) - 4:
+                code, size = struct.unpack_from(endian + 'HH', body, offset)
+                if code == 0:
+                    break
+                if code == 9:
+                    value = body[offset + 4]
+                    resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+                offset += 4 + size + (-size & 3)
+            interfaces.append((linktype, resolution))
+        elif block_type == 6:
+            interface, high, low, captured, _ = struct.unpack_from(endian + 'IIIII', body)
+            linktype, resolution = interfaces[interface]
+            data = body[20:20 + captured]
+
+            flags = 0
+            offset = 20 + captured + (-captured & 3)
+            while offset + 4 <= len(body) - 4:
+                code, size = struct.unpack_from(endian + 'HH', body, offset)
+                if code == 0:
+                    break
+                if code == 2:
+                    flags, = struct.unpack_from(endian + 'I', body, offset + 4)
+                offset += 4 + size + (-size & 3)
+            if flags & 0x3 == 2:
+                continue
+
+            rssi, link_quality = 0, 0
+            if linktype == 283:
+                data, rssi, link_quality = parse_tap(data)
+            elif linktype == 195:
+                data = data[:-2]
+            yield ((high << 32) | low) * resolution, data, rssi, link_quality
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        yield (record.get('timestamp', 0), unhexlify(record['packet']),
+               record.get('rssi', 0), record.get('link_quality', 0))
+
+def read_records(path):
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'\x0A\x0D\x0D\x0A':
+        with open(path, 'rb') as f:
+            yield from read_pcapng(f)
+    elif magic in (b'\xD4\xC3\xB2\xA1', b'\xA1\xB2\xC3\xD4', b'\x4D\x3C\xB2\xA1', b'\xA1\xB2\x3C\x4D'):
+        with open(path, 'rb') as f:
+            yield from read_pcap(f)
+    else:
+        with open(path, 'r') as f:
+            yield from read_jsonl(f)
+
+def replay(node, records, speed=None, drain=5.0):
+    frames = 0
+    start = perf_counter()
+    first = None
+    # Timers run in capture time, whatever the replay speed
+    clock = node.scheduler.clock = ReplayClock(monotonic())
+    base = clock.now
+    for timestamp, packet, rssi, link_quality in records:
+        if first is None:
+            first = timestamp
+        if speed:
+            delay = (timestamp - first) / speed - (perf_counter() - start)
+            if delay > 0:
+                sleep(delay)
+        clock.advance(node.scheduler, base + timestamp - first)
+        node.packet_handler(packet, rssi, link_quality)
+        node.scheduler.run_timers()
+        frames += 1
+    # Let responses still waiting on a timer go out
+    clock.advance(node.scheduler, clock.now + drain)
+    return frames, perf_counter() - start
+
+def report(frames, elapsed, sent):
+    print('frames:    %d' % frames)
+    print('elapsed:   %.3f s' % elapsed)
+    print('rate:      %.0f frames/s' % (frames / elapsed if elapsed else 0))
+    print('responses: %d' % len(sent))
+    types = Counter()
+    for packet in sent:
+        mhr = MHR.View(packet)
+        try:
+            name = str(MHR.FrameType(mhr.frame_type))
+        except ValueError:
+            name = str(mhr.frame_type)
+        if mhr.frame_type == MHR.FrameType.cmd and mhr.supported:
+            name += '.' + str(CMD.View(mhr.payload).identifier)
+        types[name] += 1
+    for name, count in sorted(types.items()):
+        print('  %-32s %d' % (name, count))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured frames through a packet handler.')
+    parser.add_argument('role', choices=['coordinator', 'device'])
+    parser.add_argument('capture', help='pcapng, pcap or JSON lines file')
+    parser.add_argument('--config', help='INI file to start from (default: <role>.ini)')
+    parser.add_argument('--long-addr', default='0000000000000000', help='long address of the replayed node')
+    parser.add_argument('--speed', type=float, help='replay at this multiple of real time instead of as fast as possible')
+    args = parser.parse_args()
+
+    config = os.path.abspath(args.config or '%s.ini' % args.role)
+    capture = os.path.abspath(args.capture)
+    records = list(read_records(capture))
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='zag-replay-')
+    try:
+        if os.path.exists(config):
+            shutil.copy(config, os.path.join(workdir, '%s.ini' % args.role))
+        os.chdir(workdir)
+
+        dev = ReplayDEV(unhexlify(args.long_addr))
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            if args.role == 'coordinator':
+                node = Coordinator(dev)
+            else:
+                node = Device(dev)
+            dev.sent.clear()
+            frames, elapsed = replay(node, records, args.speed)
+            node.log_listener.stop()
+        report(frames, elapsed, dev.sent)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
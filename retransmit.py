@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import metrics
+
+__all__ = ['Transmission', 'Retransmitter']
+
+class Transmission(object):
+    __slots__ = ('dst', 'seq_num', 'packet', 'retry', 'timer', 'on_complete', 'on_failure')
+
+    def __init__(self, dst, seq_num, packet, on_complete, on_failure):
+        self.dst = dst
+        self.seq_num = seq_num
+        self.packet = packet
+        self.retry = 0
+        self.timer = None
+        self.on_complete = on_complete
+        self.on_failure = on_failure
+
+class Retransmitter(object):
+    retransmissions = metrics.registry.counter('zag_retransmissions_total', 'Frames sent again after a missing acknowledgement')
+    failures = metrics.registry.counter('zag_retransmission_failures_total', 'Frames never acknowledged after all retries')
+    in_flight = metrics.registry.gauge('zag_retransmissions_pending', 'Frames waiting for an acknowledgement')
+
+    def __init__(self, dev, scheduler, interval=0.25, retries=10):
+        self.dev = dev
+        self.scheduler = scheduler
+        self.interval = interval
+        self.retries = retries
+        self.pending = {}
+        self.by_seq = {}
+        Retransmitter.in_flight.track((), self.__len__)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def send(self, dst, seq_num, packet, on_complete=None, on_failure=None):
+        self.cancel(dst, seq_num)
+        tx = Transmission(dst, seq_num, bytes(packet), on_complete, on_failure)
+        self.pending[(dst, seq_num)] = tx
+        self.by_seq[seq_num] = tx
+        tx.timer = self.scheduler.call_later(self.interval, self.retransmit, tx)
+        self.dev.send_packet(tx.packet)
+        return tx
+
+    def cancel(self, dst, seq_num):
+        tx = self.pending.pop((dst, seq_num), None)
+        if tx is None:
+            return None
+        tx.timer.cancel()
+        if self.by_seq.get(seq_num) is tx:
+            del self.by_seq[seq_num]
+        return tx
+
+    def ack(self, seq_num):
+        tx = self.by_seq.get(seq_num)
+        if tx is None:
+            return False
+        self.cancel(tx.dst, seq_num)
+        if tx.on_complete:
+            tx.on_complete(tx.dst)
+        return True
+
+    def retransmit(self, tx):
+        if tx.retry < self.retries:
+            tx.retry += 1
+            tx.timer = self.scheduler.call_later(self.interval, self.retransmit, tx)
+            Retransmitter.retransmissions.inc()
+            self.dev.send_packet(tx.packet)
+            return
+
+        self.cancel(tx.dst, tx.seq_num)
+        Retransmitter.failures.inc()
+        if tx.on_failure:
+            tx.on_failure(tx.dst)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+from collections import deque
+import metrics
+from zag import DEV
+
+__all__ = ['Candidate', 'Scanner']
+
+class Candidate(object):
+    __slots__ = ('channel', 'panid', 'short_addr', 'ssid', 'services', 'superframe', 'rssi', 'link_quality', 'count')
+
+    def __init__(self, channel, panid, short_addr, bcn, rssi, link_quality):
+        self.channel = channel
+        self.panid = panid
+        self.short_addr = short_addr
+        self.ssid = bcn.ssid
+        self.services = list(bcn.services)
+        self.superframe = bcn.superframe
+        self.rssi = rssi
+        self.link_quality = link_quality
+        self.count = 1
+
+    def update(self, rssi, link_quality):
+        self.rssi = max(self.rssi, rssi)
+        self.link_quality = max(self.link_quality, link_quality)
+        self.count += 1
+
+    def matches(self, ssid, service):
+        return (ssid is None or self.ssid == ssid) and service in self.services
+
+    def __repr__(self):
+        return 'Candidate(channel=%d, panid=0x%04X, short_addr=0x%04X, ssid=%r, services=%r, rssi=%d, link_quality=%d)' % (
+            self.channel, self.panid, self.short_addr, self.ssid, self.services, self.rssi, self.link_quality)
+
+class Scanner(object):
+    # Queued behind a radio's channel change so beacons heard before it are not credited to the new channel
+    event = 'scan_tuned'
+
+    scans = metrics.registry.counter('zag_scans_total', 'Active scans completed')
+    channels_scanned = metrics.registry.counter('zag_scan_channels_total', 'Channels visited by active scans')
+    beacons = metrics.registry.counter('zag_scan_beacons_total', 'Beacons collected by active scans')
+
+    def __init__(self, dev, scheduler, request):
+        self.dev = dev
+        self.scheduler = scheduler
+        self.request = request
+        self.plans = {}
+        self.tuned = {}
+        self.timers = {}
+        self.candidates = {}
+        self.dwell = 0
+        self.ssid = None
+        self.service = None
+        self.on_complete = None
+
+    @property
+    def active(self):
+        return bool(self.plans)
+
+    def channels(self):
+        _, channel_min = self.dev.get_value(DEV.Param.channel_min)
+        _, channel_max = self.dev.get_value(DEV.Param.channel_max)
+        return range(channel_min, channel_max + 1)
+
+    def start(self, dwell, on_complete, ssid=None, service=None, channels=None):
+        self.cancel()
+        channels = list(self.channels() if channels is None else channels)
+        radios = self.dev.radios[:len(channels)]
+        if not radios:
+            on_complete([])
+            return
+        self.dwell = dwell
+        self.ssid = ssid
+        self.service = service
+        self.on_complete = on_complete
+        self.candidates = {}
+        size = -(-len(channels) // len(radios))
+        for i, radio in enumerate(radios):
+            self.plans[radio] = deque(channels[i * size:(i + 1) * size])
+        for radio in radios:
+            self.step(radio)
+
+    def step(self, radio):
+        self.tuned.pop(radio, None)
+        self.timers.pop(radio, None)
+        plan = self.plans.get(radio)
+        if plan is None:
+            return
+        if not plan:
+            del self.plans[radio]
+            if not self.plans:
+                self.finish()
+            return
+        channel = plan.popleft()
+        try:
+            radio.set_value(DEV.Param.channel, channel)
+        except DEV.LinkError:
+            # Try the channel again once the radio is back
+            plan.appendleft(channel)
+            self.timers[radio] = self.scheduler.call_later(self.dwell, self.step, radio)
+            raise
+        radio.event_queue.put_nowait((Scanner.event, (radio, channel)))
+
+    def tuned_handler(self, radio, channel):
+        if radio not in self.plans:
+            return
+        self.tuned[radio] = channel
+        Scanner.channels_scanned.inc()
+        self.timers[radio] = self.scheduler.call_later(self.dwell, self.step, radio)
+        radio.send_packet(self.request())
+
+    def beacon(self, radio, mhr, bcn, rssi, link_quality):
+        channel = self.tuned.get(radio)
+        if channel is None:
+            return False
+        Scanner.beacons.inc()
+        key = (channel, mhr.src_panid, mhr.src_addr)
+        candidate = self.candidates.get(key)
+        if candidate is None:
+            self.candidates[key] = Candidate(channel, mhr.src_panid, mhr.src_addr, bcn, rssi, link_quality)
+        else:
+            candidate.update(rssi, link_quality)
+        return True
+
+    def rank(self):
+        def key(candidate):
+            return (candidate.ssid == self.ssid, self.service in candidate.services, candidate.link_quality, candidate.rssi)
+        return sorted(self.candidates.values(), key=key, reverse=True)
+
+    def finish(self):
+        Scanner.scans.inc()
+        on_complete, self.on_complete = self.on_complete, None
+        if on_complete:
+            on_complete(self.rank())
+
+    def cancel(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.plans.clear()
+        self.tuned.clear()
+        self.timers.clear()
+        self.on_complete = None
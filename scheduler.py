@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+from heapq import heappop, heappush
+from itertools import count
+import logging
+from queue import Empty
+from time import monotonic
+
+__all__ = ['Timer', 'Scheduler']
+
+log = logging.getLogger('scheduler')
+
+class Timer(object):
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Scheduler(object):
+    def __init__(self, errors=(), clock=monotonic):
+        self.timers = []
+        self.counter = count()
+        # Exceptions a timer callback may raise without taking the remaining timers down with it
+        self.errors = errors
+        self.clock = clock
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        heappush(self.timers, (deadline, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def timeout(self):
+        while self.timers and self.timers[0][2].cancelled:
+            heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0, self.timers[0][0] - self.clock())
+
+    def run_timers(self):
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heappop(self.timers)
+            if not timer.cancelled:
+                timer.cancelled = True
+                try:
+                    timer.callback(*timer.args)
+                except self.errors as e:
+                    log.warning('%s failed: %s', getattr(timer.callback, '__name__', timer.callback), e)
+
+    def run(self, queue, handlers):
+        while True:
+            try:
+                event, data = queue.get(timeout=self.timeout())
+            except Empty:
+                pass
+            else:
+                handler = handlers.get(event)
+                if handler:
+                    handler(*data)
+            self.run_timers()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import argparse
+from heapq import heappop, heappush
+from itertools import count
+import os
+import random
+import selectors
+import struct
+import sys
+from time import monotonic
+import tty
+from zag import DEV
+
+__all__ = ['Channel', 'Radio', 'Simulator']
+
+class Channel(object):
+    def __init__(self, loss=0.0, latency=0.001, jitter=0.0, rssi=-60, rssi_spread=0, link_quality=255,
+                 noise_floor=-95, interference=None):
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.rssi = rssi
+        self.rssi_spread = rssi_spread
+        self.link_quality = link_quality
+        self.noise_floor = noise_floor
+        # channel -> (energy in dBm, fraction of time the interferer is on air)
+        self.interference = interference or {}
+
+    @staticmethod
+    def parse_interference(spec):
+        interference = {}
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            channel, level, duty = item.split(':')
+            interference[int(channel)] = (int(level), float(duty))
+        return interference
+
+class Radio(object):
+    sync = b'\xAAZAG'
+    requests = frozenset(request.value for request in DEV.Request)
+
+    def __init__(self, simulator, index, long_addr):
+        self.simulator = simulator
+        self.index = index
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self.slave)
+        self.buffer = bytearray()
+        self.memory = bytearray(0x10000)
+        self.leds = 0
+        self.long_addr = long_addr
+        self.values = {
+            DEV.Param.power_mode: 0,
+            DEV.Param.channel: 11,
+            DEV.Param.panid: 0xFFFF,
+            DEV.Param.short_addr: 0xFFFE,
+            DEV.Param.rx_mode: 0,
+            DEV.Param.tx_mode: 0,
+            DEV.Param.tx_power: 0,
+            DEV.Param.cca_threshold: -77 & 0xFFFF,
+            DEV.Param.rssi: -95 & 0xFFFF,
+            DEV.Param.last_rssi: 0,
+            DEV.Param.last_link_quality: 0,
+            DEV.Param.last_packet_timestamp: 0,
+            DEV.Param.channel_min: 11,
+            DEV.Param.channel_max: 26,
+            DEV.Param.txpower_min: -24 & 0xFFFF,
+            DEV.Param.txpower_max: 5,
+        }
+        self.constants = {
+            DEV.Param.rssi,
+            DEV.Param.last_rssi,
+            DEV.Param.last_link_quality,
+            DEV.Param.last_packet_timestamp,
+            DEV.Param.channel_min,
+            DEV.Param.channel_max,
+            DEV.Param.txpower_min,
+            DEV.Param.txpower_max,
+        }
+
+    @property
+    def channel(self):
+        return self.values[DEV.Param.channel]
+
+    def write(self, data):
+        try:
+            os.write(self.master, data)
+        except BlockingIOError:
+            self.simulator.overruns += 1
+
+    def respond(self, data=b'', response=DEV.Response.ok):
+        self.write(DEV.header_struct.pack(response, len(data)) + data)
+
+    def event(self, event, data):
+        self.write(DEV.header_struct.pack(event, len(data)) + data)
+
+    def readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        self.buffer += data
+
+        while self.buffer:
+            if self.buffer.startswith(Radio.sync):
+                del self.buffer[:len(Radio.sync)]
+                self.write(Radio.sync)
+                continue
+            if self.buffer[0] not in Radio.requests:
+                i = self.buffer.find(Radio.sync)
+                if i < 0:
+                    del self.buffer[:-(len(Radio.sync) - 1)]
+                    return
+                del self.buffer[:i]
+                continue
+            if len(self.buffer) < DEV.header_struct.size:
+                return
+            request, data_len = DEV.header_struct.unpack_from(self.buffer)
+            end = DEV.header_struct.size + data_len
+            if len(self.buffer) < end:
+                return
+            data = bytes(self.buffer[DEV.header_struct.size:end])
+            del self.buffer[:end]
+            try:
+                self.request(DEV.Request(request), data)
+            except struct.error:
+                self.respond(response=DEV.Response.err)
+
+    def request(self, request, data):
+        if request == DEV.Request.send_packet:
+            self.simulator.transmit(self, data)
+            self.respond(struct.pack('!H', DEV.TransmitResult.ok))
+        elif request in (DEV.Request.get_mem, DEV.Request.get_mem_rev):
+            addr, n = struct.unpack('!HB', data)
+            mem = bytes(self.memory[addr:addr + n])
+            self.respond(mem[::-1] if request == DEV.Request.get_mem_rev else mem)
+        elif request in (DEV.Request.set_mem, DEV.Request.set_mem_rev):
+            addr, = struct.unpack_from('!H', data)
+            mem = data[2:][::-1] if request == DEV.Request.set_mem_rev else data[2:]
+            self.memory[addr:addr + len(mem)] = mem[:0x10000 - addr]
+            self.respond()
+        elif request == DEV.Request.get_value:
+            param, = struct.unpack('!H', data)
+            if param == DEV.Param.rssi:
+                self.respond(struct.pack('!HH', DEV.Result.ok, self.simulator.energy(self.channel) & 0xFFFF))
+            elif param in self.values:
+                self.respond(struct.pack('!HH', DEV.Result.ok, self.values[param]))
+            else:
+                self.respond(struct.pack('!HH', DEV.Result.not_supported, 0))
+        elif request == DEV.Request.set_value:
+            param, value = struct.unpack('!HH', data)
+            self.respond(struct.pack('!H', self.set_value(param, value)))
+        elif request == DEV.Request.get_object:
+            param, expected_len = struct.unpack('!HB', data)
+            if param == DEV.Param.long_addr:
+                self.respond(struct.pack('!H', DEV.Result.ok) + self.long_addr[:expected_len])
+            else:
+                self.respond(struct.pack('!H', DEV.Result.not_supported))
+        elif request == DEV.Request.set_object:
+            param, data_len = struct.unpack_from('!HH', data)
+            if param == DEV.Param.long_addr and data_len == 8:
+                self.long_addr = data[4:12]
+                self.respond(struct.pack('!H', DEV.Result.ok))
+            else:
+                self.respond(struct.pack('!H', DEV.Result.not_supported))
+        elif request == DEV.Request.get_leds:
+            self.respond(struct.pack('!B', self.leds))
+        elif request == DEV.Request.set_leds:
+            mask, values = struct.unpack('!BB', data)
+            self.leds = (self.leds & ~mask) | (values & mask)
+            self.respond()
+
+    def set_value(self, param, value):
+        if param not in self.values:
+            return DEV.Result.not_supported
+        if param in self.constants:
+            return DEV.Result.not_supported
+        if param == DEV.Param.channel:
+            if not self.values[DEV.Param.channel_min] <= value <= self.values[DEV.Param.channel_max]:
+                return DEV.Result.invalid_value
+        self.values[param] = value
+        return DEV.Result.ok
+
+    def receive(self, packet, rssi, link_quality):
+        self.values[DEV.Param.last_rssi] = rssi & 0xFFFF
+        self.values[DEV.Param.last_link_quality] = link_quality
+        self.values[DEV.Param.last_packet_timestamp] = int(monotonic() * 1000) & 0xFFFF
+        self.event(DEV.Event.on_packet, packet + struct.pack('!bB', rssi, link_quality))
+
+    def button(self, button=1):
+        self.event(DEV.Event.on_button, struct.pack('!B', button))
+
+class Simulator(object):
+    def __init__(self, nodes, channel=None, seed=None):
+        self.channel = channel or Channel()
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.deliveries = []
+        self.counter = count()
+        self.transmitted = 0
+        self.delivered = 0
+        self.lost = 0
+        self.overruns = 0
+        self.radios = []
+        for index in range(nodes):
+            radio = Radio(self, index, struct.pack('!4sI', b'ZAG\x00', index))
+            self.selector.register(radio.master, selectors.EVENT_READ, radio)
+            self.radios.append(radio)
+
+    def transmit(self, sender, packet):
+        self.transmitted += 1
+        now = monotonic()
+        for radio in self.radios:
+            if radio is sender or radio.channel != sender.channel:
+                continue
+            if self.random.random() < self.channel.loss:
+                self.lost += 1
+                continue
+            latency = self.channel.latency + self.random.uniform(0, self.channel.jitter)
+            rssi = self.channel.rssi + self.random.randint(-self.channel.rssi_spread, self.channel.rssi_spread)
+            rssi = max(-128, min(127, rssi))
+            heappush(self.deliveries, (now + latency, next(self.counter), radio, packet, rssi))
+
+    def energy(self, channel):
+        level, duty = self.channel.interference.get(channel, (self.channel.noise_floor, 0.0))
+        if self.random.random() < duty:
+            return max(-128, min(127, level + self.random.randint(-3, 3)))
+        return self.channel.noise_floor + self.random.randint(-2, 2)
+
+    def deliver(self):
+        now = monotonic()
+        while self.deliveries and self.deliveries[0][0] <= now:
+            _, _, radio, packet, rssi = heappop(self.deliveries)
+            radio.receive(packet, rssi, self.channel.link_quality)
+            self.delivered += 1
+
+    def command(self, line):
+        args = line.split()
+        if not args:
+            return
+        if args[0] in ('b', 'button') and len(args) >= 2:
+            button = int(args[2]) if len(args) > 2 else 1
+            self.radios[int(args[1])].button(button)
+        elif args[0] in ('l', 'list'):
+            for radio in self.radios:
+                print('%4d %-14s ch %2d leds 0x%02X %s' % (radio.index, radio.name, radio.channel,
+                                                         radio.leds, radio.long_addr.hex().upper()))
+        elif args[0] in ('s', 'stats'):
+            print('transmitted %d delivered %d lost %d overruns %d' % (self.transmitted, self.delivered,
+                                                                      self.lost, self.overruns))
+        else:
+            print('commands: button <node> [n], list, stats')
+
+    def run(self, interactive=True):
+        if interactive:
+            self.selector.register(sys.stdin, selectors.EVENT_READ, None)
+        while True:
+            timeout = None
+            if self.deliveries:
+                timeout = max(0, self.deliveries[0][0] - monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    line = sys.stdin.readline()
+                    if not line:
+                        self.selector.unregister(sys.stdin)
+                        continue
+                    self.command(line)
+                else:
+                    key.data.readable()
+            self.deliver()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate ZAG radios on pseudo-terminals.')
+    parser.add_argument('-n', '--nodes', type=int, default=2)
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a frame is lost per receiver')
+    parser.add_argument('--latency', type=float, default=0.001, help='delivery latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='additional random latency in seconds')
+    parser.add_argument('--rssi', type=int, default=-60, help='received signal strength in dBm')
+    parser.add_argument('--rssi-spread', type=int, default=0, help='random RSSI variation in dB')
+    parser.add_argument('--noise-floor', type=int, default=-95, help='energy detected on a quiet channel in dBm')
+    parser.add_argument('--interference', default='',
+                        help='busy channels as channel:dBm:duty, e.g. 11:-60:0.4,12:-70:0.2')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--ports-file', help='write the pseudo-terminal names to this file, one per line')
+    args = parser.parse_args()
+
+    channel = Channel(args.loss, args.latency, args.jitter, args.rssi, args.rssi_spread,
+                      noise_floor=args.noise_floor, interference=Channel.parse_interference(args.interference))
+    simulator = Simulator(args.nodes, channel, args.seed)
+    for radio in simulator.radios:
+        print('%4d %s' % (radio.index, radio.name))
+    if args.ports_file:
+        with open(args.ports_file, 'w') as ports_file:
+            for radio in simulator.radios:
+                ports_file.write(radio.name + '\n')
+    sys.stdout.flush()
+
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
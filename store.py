@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+from binascii import hexlify, unhexlify
+from configparser import ConfigParser
+import sqlite3
+import sys
+
+__all__ = ['Store']
+
+class Store(object):
+    def __init__(self, path, batch=64):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS devices ('
+                        'short_addr INTEGER PRIMARY KEY, '
+                        'long_addr BLOB NOT NULL UNIQUE)')
+        self.db.commit()
+        self.batch = batch
+        self.dirty = 0
+
+    def __len__(self):
+        count, = self.db.execute('SELECT COUNT(*) FROM devices').fetchone()
+        return count
+
+    def items(self):
+        return self.db.execute('SELECT short_addr, long_addr FROM devices ORDER BY short_addr')
+
+    def load(self, registry):
+        for short_addr, long_addr in self.items():
+            registry.add(short_addr, long_addr)
+
+    def add(self, short_addr, long_addr):
+        self.db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?)', (short_addr, bytes(long_addr)))
+        self.changed()
+
+    def remove(self, short_addr):
+        self.db.execute('DELETE FROM devices WHERE short_addr = ?', (short_addr,))
+        self.changed()
+
+    def changed(self):
+        self.dirty += 1
+        if self.dirty >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.dirty:
+            self.db.commit()
+            self.dirty = 0
+
+    def compact(self):
+        self.flush()
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.compact()
+        self.db.close()
+
+    def import_ini(self, config, section='devices'):
+        for short_addr, long_addr in config.items(section):
+            self.add(int(short_addr, 0), unhexlify(long_addr.encode('utf8')))
+        self.flush()
+
+    def merge_ini(self, config, section='devices'):
+        conflicts = []
+        for short_addr, long_addr in config.items(section):
+            short_addr, long_addr = int(short_addr, 0), unhexlify(long_addr.encode('utf8'))
+            rows = self.db.execute('SELECT short_addr, long_addr FROM devices WHERE short_addr = ? OR long_addr = ?',
+                                   (short_addr, long_addr)).fetchall()
+            if not rows:
+                self.add(short_addr, long_addr)
+            elif rows != [(short_addr, long_addr)]:
+                conflicts.append((short_addr, long_addr))
+        self.flush()
+        return conflicts
+
+    def export_ini(self, config, section='devices'):
+        if not config.has_section(section):
+            config.add_section(section)
+        for short_addr, long_addr in self.items():
+            config[section]['0x%04X' % short_addr] = hexlify(long_addr).decode('utf8').upper()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export'):
+        print('usage: %s import|export <store> <ini>' % sys.argv[0])
+        sys.exit(1)
+
+    command, path, ini = sys.argv[1:]
+    store = Store(path)
+    config = ConfigParser()
+    config.optionxform = str
+    config.read(ini)
+    if command == 'import':
+        store.import_ini(config)
+    else:
+        store.export_ini(config)
+        with open(ini, 'w') as config_file:
+            config.write(config_file)
+    store.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+from time import monotonic
+from zag import *
+
+__all__ = ['ChannelStats', 'survey', 'quietest']
+
+class ChannelStats(object):
+    __slots__ = ('channel', 'samples', 'mean', 'peak', 'p90', 'occupancy')
+
+    def __init__(self, channel, samples, threshold):
+        samples = sorted(samples)
+        self.channel = channel
+        self.samples = len(samples)
+        self.mean = sum(samples) / len(samples)
+        self.peak = samples[-1]
+        self.p90 = samples[min(len(samples) - 1, len(samples) * 9 // 10)]
+        self.occupancy = sum(1 for sample in samples if sample > threshold) / len(samples)
+
+    def format(self):
+        return 'mean %.1f p90 %d peak %d occupancy %.3f samples %d' % (
+            self.mean, self.p90, self.peak, self.occupancy, self.samples)
+
+    def __repr__(self):
+        return 'ChannelStats(channel=%d, %s)' % (self.channel, self.format())
+
+def to_dbm(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+def survey(dev, channels=None, samples=128, threshold=-75):
+    radios = dev.radios
+    if channels is None:
+        _, channel_min = dev.get_value(DEV.Param.channel_min)
+        _, channel_max = dev.get_value(DEV.Param.channel_max)
+        channels = range(channel_min, channel_max + 1)
+    channels = list(channels)
+
+    results = {}
+    for i in range(0, len(channels), len(radios)):
+        batch = list(zip(radios, channels[i:i + len(radios)]))
+        for future in [radio.set_value(DEV.Param.channel, channel, block=False) for radio, channel in batch]:
+            result = future.result()
+            if result[0] != DEV.Result.ok:
+                raise ValueError('cannot tune to channel: %s' % result[0].name)
+        # Keep every radio's request window full; rssi is volatile so each read goes to the radio
+        futures = [[] for _ in batch]
+        for _ in range(samples):
+            for (radio, _), pending in zip(batch, futures):
+                pending.append(radio.get_value(DEV.Param.rssi, block=False))
+        for (_, channel), pending in zip(batch, futures):
+            values = [to_dbm(value) for result, value in (future.result() for future in pending)
+                      if result == DEV.Result.ok]
+            if values:
+                results[channel] = ChannelStats(channel, values, threshold)
+    return results
+
+def quietest(results, n=1):
+    ranked = sorted(results.values(), key=lambda stats: (stats.occupancy, stats.p90, stats.mean))
+    return [stats.channel for stats in ranked[:n]]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the energy on every channel.')
+    parser.add_argument('ports', nargs='+')
+    parser.add_argument('-n', '--samples', type=int, default=128, help='rssi reads per channel')
+    parser.add_argument('--threshold', type=int, default=-75, help='energy in dBm that counts as busy')
+    args = parser.parse_args()
+
+    dev = DEVGroup(args.ports) if len(args.ports) > 1 else DEV(args.ports[0])
+    start = monotonic()
+    results = survey(dev, samples=args.samples, threshold=args.threshold)
+    elapsed = monotonic() - start
+    for channel, stats in sorted(results.items()):
+        print('%2d %s' % (channel, stats.format()))
+    reads = sum(stats.samples for stats in results.values())
+    print('%d reads in %.3f s (%.0f reads/s), quietest channel %s' % (
+        reads, elapsed, reads / elapsed if elapsed else 0, ','.join(str(c) for c in quietest(results))))
+    dev.shutdown()
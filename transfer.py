@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from enum import IntEnum, unique
+import metrics
+from random import randint
+import struct
+from time import monotonic
+from zag import *
+
+__all__ = ['Transfer', 'Reassembly', 'Transfers']
+
+# Transfer ids are 32 bits and start at a random value on every boot, so a restarted
+# sender does not reuse an id the receiver still remembers as finished
+fragment_struct = struct.Struct('!BIHHI')
+sack_struct = struct.Struct('!BIHI')
+abort_struct = struct.Struct('!BI')
+
+# Largest frame handed to DEV.send_packet; the radio appends the 2 byte FCS
+max_frame = 125
+
+class Transfer(object):
+    __slots__ = ('dst', 'id', 'data', 'size', 'fragment_size', 'count', 'base', 'next', 'acked',
+                 'sent', 'rtt', 'retry', 'timer', 'started', 'finished', 'retransmitted', 'on_complete', 'on_failure')
+
+    def __init__(self, dst, id, data, fragment_size, on_complete, on_failure):
+        self.dst = dst
+        self.id = id
+        self.data = memoryview(bytes(data))
+        self.size = len(data)
+        self.fragment_size = fragment_size
+        self.count = max(1, -(-self.size // fragment_size))
+        self.base = 0
+        self.next = 0
+        self.acked = bytearray(self.count)
+        self.sent = [0.0] * self.count
+        self.rtt = None
+        self.retry = 0
+        self.timer = None
+        self.started = monotonic()
+        self.finished = None
+        self.retransmitted = 0
+        self.on_complete = on_complete
+        self.on_failure = on_failure
+
+    def fragment(self, index):
+        return self.data[index * self.fragment_size:(index + 1) * self.fragment_size]
+
+    @property
+    def goodput(self):
+        elapsed = (self.finished or monotonic()) - self.started
+        return self.size / elapsed if elapsed > 0 else 0.0
+
+class Reassembly(object):
+    __slots__ = ('src', 'id', 'size', 'count', 'fragment_size', 'buffer', 'received', 'base', 'n', 'started', 'updated',
+                 'sack_timer', 'stale_timer')
+
+    def __init__(self, src, id, size, count, fragment_size, buffer):
+        self.src = src
+        self.id = id
+        self.size = size
+        self.count = count
+        self.fragment_size = fragment_size
+        self.buffer = buffer
+        self.received = bytearray(count)
+        self.base = 0
+        self.n = 0
+        self.started = self.updated = monotonic()
+        self.sack_timer = None
+        self.stale_timer = None
+
+    def add(self, index, fragment):
+        if self.received[index]:
+            return False
+        offset = index * self.fragment_size
+        # Every fragment but the last is full sized, and the last one ends the announced message
+        if len(fragment) != min(self.fragment_size, self.size - offset):
+            return False
+        self.buffer[offset:offset + len(fragment)] = fragment
+        self.received[index] = 1
+        self.n += 1
+        while self.base < self.count and self.received[self.base]:
+            self.base += 1
+        self.updated = monotonic()
+        return True
+
+    def bitmap(self):
+        bitmap = 0
+        for i in range(32):
+            index = self.base + i
+            if index >= self.count:
+                break
+            if self.received[index]:
+                bitmap |= 1 << i
+        return bitmap
+
+    @property
+    def complete(self):
+        return self.n == self.count
+
+    @property
+    def goodput(self):
+        elapsed = self.updated - self.started
+        return self.size / elapsed if elapsed > 0 else 0.0
+
+class Transfers(object):
+    frames = metrics.registry.counter('zag_transfer_frames_total', 'Transfer frames sent and received', ('direction', 'kind'))
+    retransmissions = metrics.registry.counter('zag_transfer_retransmissions_total', 'Fragments sent again')
+    completed = metrics.registry.counter('zag_transfers_total', 'Transfers finished', ('direction', 'result'))
+    transferred = metrics.registry.counter('zag_transfer_bytes_total', 'Message bytes delivered', ('direction',))
+    goodput = metrics.registry.gauge('zag_transfer_goodput_bytes_per_second', 'Goodput of the last completed transfer', ('direction',))
+
+    min_timeout = 0.02
+
+    @unique
+    class Kind(IntEnum):
+        fragment = 0
+        sack     = 1
+        abort    = 2
+
+        def __str__(self):
+            return str(self.name)
+
+    def __init__(self, dev, scheduler, node, on_message=None, window=16, timeout=0.25, retries=8,
+                 max_size=256 * 1024, slots=2, sack_delay=0.01):
+        self.dev = dev
+        self.scheduler = scheduler
+        self.node = node
+        self.on_message = on_message
+        self.window = min(window, 32)
+        self.timeout = timeout
+        self.retries = retries
+        self.sack_delay = sack_delay
+        self.max_size = max_size
+        self.dsn = randint(0, 255)
+        self.next_id = randint(0, 0xFFFFFFFF)
+        self.outgoing = {}
+        self.incoming = {}
+        self.pool = [bytearray(max_size) for _ in range(slots)]
+        self.finished = OrderedDict()
+        self.header_templates = {}
+
+    def header(self, dst):
+        header = self.header_templates.get((self.node.panid, self.node.short_addr, dst))
+        if header is None:
+            mhr = MHR()
+            mhr.frame_control |= MHR.FrameType.data << MHR.FrameControl.type
+            mhr.frame_control |= 1 << MHR.FrameControl.panid_compression
+            mhr.frame_control |= MHR.AddrMode.short << MHR.FrameControl.dst_mode
+            mhr.frame_control |= MHR.AddrMode.short << MHR.FrameControl.src_mode
+            mhr.dst_panid = self.node.panid
+            mhr.dst_addr = dst
+            mhr.src_panid = self.node.panid
+            mhr.src_addr = self.node.short_addr
+            header = self.header_templates[(self.node.panid, self.node.short_addr, dst)] = mhr.encode()
+        return header
+
+    @property
+    def fragment_size(self):
+        return max_frame - len(self.header(0xFFFF)) - fragment_struct.size
+
+    def transmit(self, dst, kind, payload):
+        packet = bytearray(self.header(dst))
+        packet[MHR.seq_num_offset] = self.dsn
+        packet += payload
+        self.dsn = (self.dsn + 1) & 0xFF
+        Transfers.frames.inc('tx', kind.name)
+        self.dev.send_packet(packet, block=False)
+
+    def send(self, dst, data, on_complete=None, on_failure=None):
+        if not data or len(data) > 0xFFFFFFFF:
+            raise ValueError('message must be 1 to 4294967295 bytes')
+        tx = Transfer(dst, self.next_id, data, self.fragment_size, on_complete, on_failure)
+        if tx.count > 0xFFFF:
+            raise ValueError('message needs %d fragments, more than 65535' % tx.count)
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.cancel(dst, tx.id)
+        self.outgoing[(dst, tx.id)] = tx
+        self.fill(tx)
+        return tx
+
+    def send_fragment(self, tx, index):
+        tx.sent[index] = monotonic()
+        self.transmit(tx.dst, Transfers.Kind.fragment,
+                      fragment_struct.pack(Transfers.Kind.fragment, tx.id, index, tx.count, tx.size) + tx.fragment(index))
+
+    def arm(self, tx):
+        if tx.timer is None:
+            tx.timer = self.scheduler.call_later(self.rto(tx) * (1 << tx.retry), self.expire, tx)
+
+    def fill(self, tx):
+        self.arm(tx)
+        while tx.next < tx.count and tx.next < tx.base + self.window:
+            tx.next += 1
+            self.send_fragment(tx, tx.next - 1)
+
+    def rto(self, tx):
+        if tx.rtt is None:
+            return self.timeout
+        return min(self.timeout, max(Transfers.min_timeout, 4 * tx.rtt))
+
+    def expire(self, tx):
+        tx.timer = None
+        tx.retry += 1
+        if tx.retry > self.retries:
+            self.finish(tx, False)
+            return
+        self.arm(tx)
+        now = monotonic()
+        rto = self.rto(tx)
+        for index in range(tx.base, tx.next):
+            if not tx.acked[index] and now - tx.sent[index] >= rto:
+                self.resend(tx, index)
+        self.fill(tx)
+
+    def resend(self, tx, index):
+        tx.retransmitted += 1
+        Transfers.retransmissions.inc()
+        self.send_fragment(tx, index)
+
+    def sack(self, src, id, base, bitmap):
+        tx = self.outgoing.get((src, id))
+        if tx is None:
+            return
+        now = monotonic()
+        newest = None
+        for index in range(tx.base, min(base, tx.count)):
+            if not tx.acked[index]:
+                tx.acked[index] = 1
+                newest = max(newest or 0, tx.sent[index])
+        highest = -1
+        for i in range(32):
+            index = base + i
+            if index >= tx.count:
+                break
+            if bitmap & (1 << i):
+                highest = index
+                if not tx.acked[index]:
+                    tx.acked[index] = 1
+                    newest = max(newest or 0, tx.sent[index])
+        progress = newest is not None
+        if progress:
+            # The most recently sent fragment gives the least ambiguous sample under retransmission
+            sample = now - newest
+            tx.rtt = sample if tx.rtt is None else 0.875 * tx.rtt + 0.125 * sample
+        while tx.base < tx.count and tx.acked[tx.base]:
+            tx.base += 1
+        if tx.base == tx.count:
+            self.finish(tx, True)
+            return
+        # Holes below the highest acknowledged fragment were lost; resend each at most once per round trip
+        holdoff = self.rto(tx) / 2
+        for index in range(tx.base, highest):
+            if not tx.acked[index] and now - tx.sent[index] >= holdoff:
+                self.resend(tx, index)
+        if progress:
+            tx.retry = 0
+            if tx.timer:
+                tx.timer.cancel()
+                tx.timer = None
+        self.fill(tx)
+
+    def finish(self, tx, success):
+        if tx.timer:
+            tx.timer.cancel()
+            tx.timer = None
+        self.outgoing.pop((tx.dst, tx.id), None)
+        tx.finished = monotonic()
+        if success:
+            Transfers.completed.inc('tx', 'ok')
+            Transfers.transferred.add(tx.size, 'tx')
+            Transfers.goodput.set(tx.goodput, 'tx')
+            if tx.on_complete:
+                tx.on_complete(tx)
+        else:
+            Transfers.completed.inc('tx', 'failed')
+            if tx.on_failure:
+                tx.on_failure(tx)
+
+    def cancel(self, dst, id):
+        tx = self.outgoing.pop((dst, id), None)
+        if tx and tx.timer:
+            tx.timer.cancel()
+        return tx
+
+    def packet_handler(self, mhr):
+        if mhr.frame_control >> MHR.FrameControl.dst_mode & 0x3 != MHR.AddrMode.short:
+            return
+        if mhr.frame_control >> MHR.FrameControl.src_mode & 0x3 != MHR.AddrMode.short:
+            return
+        if mhr.dst_addr != self.node.short_addr or mhr.dst_panid != self.node.panid:
+            return
+        payload = mhr.payload
+        if not payload:
+            return
+        try:
+            kind = Transfers.Kind(payload[0])
+        except ValueError:
+            return
+        Transfers.frames.inc('rx', kind.name)
+        try:
+            if kind == Transfers.Kind.fragment:
+                _, id, index, count, size = fragment_struct.unpack_from(payload)
+                self.fragment(mhr.src_addr, id, index, count, size, payload[fragment_struct.size:])
+            elif kind == Transfers.Kind.sack:
+                _, id, base, bitmap = sack_struct.unpack_from(payload)
+                self.sack(mhr.src_addr, id, base, bitmap)
+            elif kind == Transfers.Kind.abort:
+                _, id = abort_struct.unpack_from(payload)
+                tx = self.outgoing.get((mhr.src_addr, id))
+                if tx:
+                    self.finish(tx, False)
+        except struct.error:
+            return
+
+    def allocate(self, src, id, size, count):
+        fragment_size = self.fragment_size
+        if size > self.max_size or not size or count != -(-size // fragment_size) or not self.pool:
+            return None
+        rx = self.incoming[(src, id)] = Reassembly(src, id, size, count, fragment_size, self.pool.pop())
+        rx.stale_timer = self.scheduler.call_later(self.timeout * (self.retries + 1), self.expire_reassembly, rx, 0)
+        return rx
+
+    def expire_reassembly(self, rx, n):
+        rx.stale_timer = None
+        if rx.n != n:
+            rx.stale_timer = self.scheduler.call_later(self.timeout * (self.retries + 1), self.expire_reassembly, rx, rx.n)
+            return
+        # No fragment for a whole period: free the slot for the next transfer and tell the sender
+        self.release(rx)
+        Transfers.completed.inc('rx', 'expired')
+        self.transmit(rx.src, Transfers.Kind.abort, abort_struct.pack(Transfers.Kind.abort, rx.id))
+
+    def release(self, rx):
+        if rx.sack_timer:
+            rx.sack_timer.cancel()
+            rx.sack_timer = None
+        if rx.stale_timer:
+            rx.stale_timer.cancel()
+            rx.stale_timer = None
+        if self.incoming.pop((rx.src, rx.id), None) is rx:
+            self.pool.append(rx.buffer)
+
+    def fragment(self, src, id, index, count, size, fragment):
+        key = (src, id)
+        if self.finished.get(key) == (count, size):
+            # The sender missed the final acknowledgement
+            self.send_sack(src, id, count, 0)
+            return
+        rx = self.incoming.get(key)
+        if rx is None:
+            rx = self.allocate(src, id, size, count)
+            if rx is None:
+                self.transmit(src, Transfers.Kind.abort, abort_struct.pack(Transfers.Kind.abort, id))
+                Transfers.completed.inc('rx', 'rejected')
+                return
+        if index >= rx.count or rx.count != count or rx.size != size:
+            return
+        rx.add(index, fragment)
+        if rx.complete:
+            message = bytes(rx.buffer[:rx.size])
+            self.release(rx)
+            self.finished[key] = (count, size)
+            while len(self.finished) > 64:
+                self.finished.popitem(last=False)
+            Transfers.completed.inc('rx', 'ok')
+            Transfers.transferred.add(len(message), 'rx')
+            Transfers.goodput.set(rx.goodput, 'rx')
+            if self.on_message:
+                self.on_message(src, message)
+            self.send_sack(src, id, count, 0)
+        elif rx.sack_timer is None:
+            rx.sack_timer = self.scheduler.call_later(self.sack_delay, self.send_pending_sack, rx)
+
+    def send_pending_sack(self, rx):
+        rx.sack_timer = None
+        self.send_sack(rx.src, rx.id, rx.base, rx.bitmap())
+
+    def send_sack(self, dst, id, base, bitmap):
+        self.transmit(dst, Transfers.Kind.sack, sack_struct.pack(Transfers.Kind.sack, id, base, bitmap))
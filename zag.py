@@ -1,17 +1,120 @@
 #!/usr/bin/env python3
 
+import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import CancelledError, Future
 from enum import IntEnum, IntFlag, unique
+import logging
+import metrics
+from operator import attrgetter
+import os
 from queue import Queue
 import random
+import select
 from serial import Serial
 import struct
-from threading import Thread
-
-__all__ = ['DEV', 'MHR', 'BCN', 'CMD', 'debug_packet']
+from threading import Event, Lock, Semaphore, Thread
+from time import perf_counter, sleep
+
+__all__ = ['Framer', 'DEV', 'AsyncDEV', 'DEVGroup', 'MHR', 'BCN', 'CMD', 'debug_packet']
+
+log = logging.getLogger('zag')
+
+class Framer(object):
+    sync = b'\xAAZAG'
+
+    # Allowed data lengths per response code; anything else means the stream is out of sync
+    limits = {0x80: (0, 255), 0x81: (0, 255), 0xC0: (2, 129), 0xC1: (1, 1)}
+    event_limits = (0, 255)
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.synced = False
+        self.resyncs = 0
+        self.desyncs = 0
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.synced = False
+
+    def compact(self):
+        # Only the partial frame left at the end moves, so every frame stays contiguous for slicing
+        n = self.end - self.start
+        self.buffer[:n] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            if self.end == len(self.buffer):
+                self.compact()
+            n = min(len(data), len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + n] = data[:n]
+            self.end += n
+            data = data[n:]
+            yield from self.frames()
+
+    def frames(self):
+        buffer = self.buffer
+        while True:
+            if not self.synced:
+                i = buffer.find(Framer.sync, self.start, self.end)
+                if i < 0:
+                    self.start = max(self.start, self.end - len(Framer.sync) + 1)
+                    return
+                self.start = i + len(Framer.sync)
+                self.synced = True
+                self.resyncs += 1
+
+            start = self.start
+            if self.end - start < DEV.header_struct.size:
+                return
+            response = buffer[start]
+            if response == Framer.sync[0]:
+                # Echo of a sync marker repeated while the first one was in flight
+                if self.end - start < len(Framer.sync):
+                    return
+                if buffer[start:start + len(Framer.sync)] == Framer.sync:
+                    self.start = start + len(Framer.sync)
+                    continue
+            data_len = buffer[start + 1]
+            limits = Framer.limits.get(response)
+            if limits is None and response >= 0xC0:
+                limits = Framer.event_limits
+            if limits is None or not limits[0] <= data_len <= limits[1]:
+                self.start = start + 1
+                self.synced = False
+                self.desyncs += 1
+                continue
+            end = start + DEV.header_struct.size + data_len
+            if end > self.end:
+                return
+            self.start = end
+            yield response, self.view[start + DEV.header_struct.size:end]
 
 class DEV(object):
     header_struct = struct.Struct('!BB')
 
+    request_latency = metrics.registry.histogram('zag_request_seconds', 'Round-trip time of radio requests', ('request',))
+    transmit_results = metrics.registry.counter('zag_transmit_results_total', 'Transmit results reported by the radio', ('result',))
+    event_queue_depth = metrics.registry.gauge('zag_event_queue_depth', 'Events waiting to be handled', ('port',))
+    pending_requests = metrics.registry.gauge('zag_pending_requests', 'Requests waiting for a response', ('port',))
+    resyncs = metrics.registry.counter('zag_resyncs_total', 'Times the reader synchronized to the serial stream', ('port',))
+    desyncs = metrics.registry.counter('zag_desyncs_total', 'Invalid frames that made the reader resynchronize', ('port',))
+    reconnects = metrics.registry.counter('zag_reconnects_total', 'Times the serial port was reopened', ('port',))
+
+    sync_interval = 0.1
+    # How long a request waits for the radio to answer the first sync after the port is opened
+    link_timeout = 5.0
+    reconnect_delays = (0.01, 5.0)
+    restore_attempts = 5
+    cache_hits = metrics.registry.counter('zag_cache_hits_total', 'Radio reads served from the parameter cache', ('request',))
+
     @unique
     class Request(IntEnum):
         send_packet = 0
@@ -48,6 +151,9 @@ class DEV(object):
     class ResponseErr(Exception):
         pass
 
+    class LinkError(Exception):
+        pass
+
     @unique
     class Result(IntEnum):
         ok            = 0
@@ -92,6 +198,11 @@ class DEV(object):
         def __str__(self):
             return str(self.name)
 
+    constant_params = frozenset([Param.long_addr, Param.channel_min, Param.channel_max,
+                                 Param.txpower_min, Param.txpower_max])
+    volatile_params = frozenset([Param.rssi, Param.last_rssi, Param.last_link_quality,
+                                 Param.last_packet_timestamp])
+
     @unique
     class RxMode(IntFlag):
         address_filter = 1
@@ -107,127 +218,743 @@ class DEV(object):
         red   = 1
         green = 2
 
-    def __init__(self, port):
-        self.serial = Serial(port, timeout=0.1)
-        self.serial.write(b'\xAAZAG')
-        self.do_sync = True
-        self.serial.flush()
-        self.reader_queue = Queue()
-        self.event_queue = Queue()
-        self.thread = Thread(target=self.reader)
+    def __init__(self, port, window=4, event_queue=None):
+        self.port = port
+        self.framer = Framer()
+        self.lock = Lock()
+        self.window = Semaphore(window)
+        self.pending = deque()
+        self.event_queue = Queue() if event_queue is None else event_queue
+        self.capture = None
+        self.settings = {}
+        self.object_settings = {}
+        self.led_settings = None
+        self.invalidate()
+        self.linked = Event()
+        self.done = False
+        self.reconnect_count = 0
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.serial = None
+        self.open()
+        self.instrument(port)
+        self.thread = Thread(target=self.reader, daemon=True)
         self.thread.start()
 
+    @property
+    def radios(self):
+        return [self]
+
+    @property
+    def current(self):
+        return self
+
+    def invalidate(self):
+        self.values = {}
+        self.objects = {}
+        self.leds = None
+
+    def cached(self, result, request, block=True):
+        DEV.cache_hits.inc(request.name)
+        if block:
+            return result
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def instrument(self, port):
+        labels = (str(port),)
+        DEV.event_queue_depth.track(labels, self.event_queue.qsize)
+        DEV.pending_requests.track(labels, lambda: len(self.pending))
+        DEV.resyncs.track(labels, lambda: self.framer.resyncs)
+        DEV.desyncs.track(labels, lambda: self.framer.desyncs)
+        DEV.reconnects.track(labels, lambda: self.reconnect_count)
+
     def shutdown(self):
+        if self.done:
+            return
         self.done = True
+        self.wakeup()
+        self.thread.join()
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def open(self):
+        serial = Serial(self.port, timeout=0)
+        self.linked.clear()
+        self.framer.reset()
+        serial.write(Framer.sync)
+        serial.flush()
+        with self.lock:
+            self.serial = serial
+
+    def close(self):
+        with self.lock:
+            serial, self.serial = self.serial, None
+        if serial:
+            try:
+                serial.close()
+            except OSError:
+                pass
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.wakeup_r], [], [], timeout)
+        if readable:
+            try:
+                os.read(self.wakeup_r, 4096)
+            except BlockingIOError:
+                pass
 
     def reader(self):
-        self.done = False
         while not self.done:
-            if self.do_sync:
-                data = self.serial.read_until(b'\xAAZAG')
+            try:
+                self.read_serial()
+            except OSError:
+                if self.done:
+                    break
+                self.close()
+                self.fail_pending(DEV.LinkError('%s disconnected' % self.port))
+                self.reconnect()
+
+        self.close()
+        self.cancel_pending()
+
+    def read_serial(self):
+        interval = DEV.sync_interval
+        next_sync = perf_counter() + interval
+        while not self.done:
+            timeout = None
+            if not self.framer.synced:
+                timeout = max(0, next_sync - perf_counter())
+            fd = self.serial.fileno()
+            readable, _, _ = select.select([fd, self.wakeup_r], [], [], timeout)
+            if self.wakeup_r in readable:
+                self.wait(0)
+                continue
+            if fd in readable:
+                data = self.serial.read(self.serial.in_waiting or 1)
                 if not data:
-                    self.serial.write(b'\xAAZAG')
-                    continue
-                elif not data.endswith(b'\xAAZAG'):
-                    continue
-                self.do_sync = False
-
-            data = self.serial.read(DEV.header_struct.size)
-            if len(data) != DEV.header_struct.size:
+                    raise OSError('%s returned no data' % self.port)
+                self.feed(data)
+                if self.framer.synced and not self.linked.is_set():
+                    self.linked.set()
+            if not self.framer.synced and perf_counter() >= next_sync:
+                self.resync()
+                # Back off while a slow radio has yet to answer the first sync
+                interval = DEV.sync_interval if self.linked.is_set() else min(interval * 2, DEV.reconnect_delays[1])
+                next_sync = perf_counter() + interval
+
+    def resync(self):
+        # Responses to requests sent before the sync marker are discarded while hunting for it
+        with self.lock:
+            self.serial.write(Framer.sync)
+            pending, self.pending = self.pending, deque()
+        self.fail(pending, DEV.LinkError('%s lost sync' % self.port))
+
+    def feed(self, data):
+        for response, data in self.framer.feed(data):
+            self.dispatch(response, data)
+
+    def reconnect(self):
+        delay, max_delay = DEV.reconnect_delays
+        while not self.done:
+            self.wait(delay)
+            if self.done:
+                return
+            try:
+                self.open()
+            except OSError:
+                delay = min(delay * 2, max_delay)
                 continue
-            response, data_len = DEV.header_struct.unpack(data)
+            self.reconnect_count += 1
+            self.invalidate()
+            Thread(target=self.restore, args=(self.reconnect_count,), daemon=True).start()
+            return
 
-            data = self.serial.read(data_len)
-            if len(data) != data_len:
+    def restore(self, generation):
+        delay, max_delay = DEV.reconnect_delays
+        attempt = 0
+        # A newer reconnect starts its own restore
+        while not self.done and generation == self.reconnect_count:
+            if not self.linked.wait(DEV.sync_interval):
                 continue
-
-            if response & 0xC0 == 0xC0:
-                event = DEV.Event(response)
-                if event == DEV.Event.on_packet:
-                    rssi, link_quality = struct.unpack('!bB', data[-2:])
-                    data = (data[:-2], rssi)
-                elif event == DEV.Event.on_button:
-                    data = struct.unpack('!B', data)
-                self.event_queue.put((event, data))
+            try:
+                rejected = self.replay()
+            except (DEV.LinkError, DEV.ResponseErr, CancelledError) as e:
+                attempt += 1
+                if attempt >= DEV.restore_attempts:
+                    log.error('%s: giving up restoring radio settings: %s', self.port, e)
+                    return
+                log.warning('%s: restoring radio settings failed, retrying: %s', self.port, e)
+                sleep(delay)
+                delay = min(delay * 2, max_delay)
                 continue
+            if rejected:
+                log.warning('%s: radio rejected restored settings: %s', self.port, ', '.join(rejected))
+            else:
+                log.info('%s: restored radio settings after reconnect', self.port)
+            return
 
+    def replay(self):
+        rejected = []
+        for param, value in list(self.settings.items()):
+            if self.set_value(param, value)[0] != DEV.Result.ok:
+                rejected.append(param.name)
+        for param, value in list(self.object_settings.items()):
+            if self.set_object(param, value)[0] != DEV.Result.ok:
+                rejected.append(param.name)
+        if self.led_settings is not None:
+            self.set_leds(0xFF, self.led_settings)
+        return rejected
+
+    def dispatch(self, response, data):
+        if response & 0xC0 == 0xC0:
             try:
-                response = DEV.Response(response)
-                self.reader_queue.put((response, data))
-            except:
-                pass
+                event = DEV.Event(response)
+            except ValueError:
+                return
+            if event == DEV.Event.on_packet:
+                rssi, link_quality = struct.unpack_from('!bB', data, len(data) - 2)
+                data = (bytes(data[:-2]), rssi, link_quality)
+                if self.capture:
+                    self.capture.rx(*data)
+            elif event == DEV.Event.on_button:
+                data = struct.unpack_from('!B', data)
+            self.event_queue.put_nowait((event, data))
+            return
 
-    def write(self, cmd, data=b''):
-        packet = DEV.header_struct.pack(cmd.value, len(data)) + data
-        self.serial.write(packet)
-        response, data = self.reader_queue.get()
+        try:
+            response = DEV.Response(response)
+        except ValueError:
+            return
+        self.complete(response, data)
+
+    def complete(self, response, data):
+        with self.lock:
+            if not self.pending:
+                return
+            future, parse, request, start = self.pending.popleft()
+        self.window.release()
+        DEV.request_latency.observe(perf_counter() - start, request.name)
+        if future.cancelled():
+            return
         if response == DEV.Response.err:
-            raise DEV.ResponseErr
-        return data
-
-    def send_packet(self, data):
-        data = self.write(DEV.Request.send_packet, data)
-        result, = struct.unpack('!H', data)
+            future.set_exception(DEV.ResponseErr())
+            return
+        try:
+            if parse:
+                data = parse(data)
+            else:
+                data = bytes(data)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(data)
+
+    def cancel_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, deque()
+        for entry in pending:
+            self.window.release()
+            entry[0].cancel()
+
+    def fail_pending(self, exception):
+        with self.lock:
+            pending, self.pending = self.pending, deque()
+        self.fail(pending, exception)
+
+    def fail(self, pending, exception):
+        for entry in pending:
+            self.window.release()
+            if not entry[0].cancelled():
+                entry[0].set_exception(exception)
+
+    def write(self, cmd, data=b'', parse=None, block=True):
+        packet = DEV.header_struct.pack(cmd.value, len(data)) + data
+        future = Future()
+        # Wait for the first sync echo, so a slow radio cannot pair a late echo with the wrong responses
+        if not self.linked.is_set() and not self.linked.wait(DEV.link_timeout):
+            raise DEV.LinkError('%s did not answer sync' % self.port)
+        self.window.acquire()
+        with self.lock:
+            if self.serial is None:
+                self.window.release()
+                raise DEV.LinkError('%s is not connected' % self.port)
+            self.pending.append((future, parse, cmd, perf_counter()))
+            try:
+                self.serial.write(packet)
+            except OSError as e:
+                self.pending.pop()
+                self.window.release()
+                raise DEV.LinkError(str(e)) from e
+            except:
+                self.pending.pop()
+                self.window.release()
+                raise
+        if block:
+            return future.result()
+        return future
+
+    @staticmethod
+    def parse_result(data):
+        result, = struct.unpack_from('!H', data)
+        return DEV.Result(result),
+
+    @staticmethod
+    def parse_transmit_result(data):
+        result, = struct.unpack_from('!H', data)
         result = DEV.TransmitResult(result)
+        DEV.transmit_results.inc(result.name)
         return result,
 
-    def get_mem(self, addr, n=1, reverse=False):
+    @staticmethod
+    def parse_value(data):
+        result, value = struct.unpack_from('!HH', data)
+        return DEV.Result(result), value
+
+    @staticmethod
+    def parse_object(data):
+        result, = struct.unpack_from('!H', data)
+        return DEV.Result(result), bytes(data[2:])
+
+    @staticmethod
+    def parse_leds(data):
+        leds, = struct.unpack_from('!B', data)
+        return leds
+
+    def send_packet(self, data, block=True):
+        if self.capture:
+            self.capture.tx(data)
+        return self.write(DEV.Request.send_packet, data, DEV.parse_transmit_result, block)
+
+    def get_mem(self, addr, n=1, reverse=False, block=True):
         data = struct.pack('!HB', int(addr), int(n))
+        parse = (lambda data: data[0]) if n == 1 else None
         if reverse:
-            data = self.write(DEV.Request.get_mem_rev, data)
-        else:
-            data = self.write(DEV.Request.get_mem, data)
-        if n == 1:
-            data = data[0]
-        return data
+            return self.write(DEV.Request.get_mem_rev, data, parse, block)
+        return self.write(DEV.Request.get_mem, data, parse, block)
 
-    def set_mem(self, addr, data, reverse=False):
+    def set_mem(self, addr, data, reverse=False, block=True):
         if isinstance(data, int):
             data = struct.pack('!HB', int(addr), data)
         else:
             data = struct.pack('!H', int(addr)) + data
         if reverse:
-            self.write(DEV.Request.set_mem_rev, data)
-        else:
-            self.write(DEV.Request.set_mem, data)
+            return self.write(DEV.Request.set_mem_rev, data, lambda data: None, block)
+        return self.write(DEV.Request.set_mem, data, lambda data: None, block)
+
+    def get_value(self, param, block=True):
+        cached = self.values.get(param)
+        if cached is not None:
+            return self.cached(cached, DEV.Request.get_value, block)
+
+        def parse(data):
+            result = DEV.parse_value(data)
+            # Settable params are shadowed from set_value, so only constants are worth keeping from a read
+            if result[0] == DEV.Result.ok and param in DEV.constant_params:
+                self.values[param] = result
+            return result
 
-    def get_value(self, param):
         data = struct.pack('!H', int(param))
-        data = self.write(DEV.Request.get_value, data)
-        result, value = struct.unpack('!HH', data)
-        result = DEV.Result(result)
-        return result, value
+        return self.write(DEV.Request.get_value, data, parse, block)
+
+    def set_value(self, param, value, block=True):
+        shadowed = param not in DEV.volatile_params and param not in DEV.constant_params
+
+        def parse(data):
+            result = DEV.parse_result(data)
+            if result[0] == DEV.Result.ok and shadowed:
+                self.values[param] = (DEV.Result.ok, value)
+                self.settings[param] = value
+            else:
+                self.values.pop(param, None)
+                self.settings.pop(param, None)
+            return result
 
-    def set_value(self, param, value):
         data = struct.pack('!HH', int(param), value)
-        data = self.write(DEV.Request.set_value, data)
-        result, = struct.unpack('!H', data)
-        result = DEV.Result(result)
-        return result,
-    
-    def get_object(self, param, expected_len):
+        return self.write(DEV.Request.set_value, data, parse, block)
+
+    def get_object(self, param, expected_len, block=True):
+        cached = self.objects.get(param)
+        if cached is not None and len(cached[1]) == expected_len:
+            return self.cached(cached, DEV.Request.get_object, block)
+
+        def parse(data):
+            result = DEV.parse_object(data)
+            if result[0] == DEV.Result.ok and param in DEV.constant_params:
+                self.objects[param] = result
+            return result
+
         data = struct.pack('!HB', int(param), expected_len)
-        data = self.write(DEV.Request.get_object, data)
-        result, = struct.unpack('!H', data[:2])
-        result = DEV.Result(result)
-        return result, data[2:]
-
-    def set_object(self, param, data):
-        data = struct.pack('!HH', int(param), len(data)) + data
-        data = self.write(DEV.Request.set_object, data)
-        result, = struct.unpack('!H', data)
-        result = DEV.Result(result)
-        return result,
+        return self.write(DEV.Request.get_object, data, parse, block)
 
-    def get_leds(self):
-        data = self.write(DEV.Request.get_leds)
-        leds, = struct.unpack('!B', data)
-        return leds
+    def set_object(self, param, data, block=True):
+        value = bytes(data)
+        shadowed = param not in DEV.constant_params
 
-    def set_leds(self, mask, values):
-        data = struct.pack('!BB', int(mask) & 0xFF, int(values) & 0xFF)
-        self.write(DEV.Request.set_leds, data)
-        return True
+        def parse(data):
+            result = DEV.parse_result(data)
+            if result[0] == DEV.Result.ok and shadowed:
+                self.objects[param] = (DEV.Result.ok, value)
+                self.object_settings[param] = value
+            else:
+                self.objects.pop(param, None)
+                self.object_settings.pop(param, None)
+            return result
+
+        data = struct.pack('!HH', int(param), len(value)) + value
+        return self.write(DEV.Request.set_object, data, parse, block)
+
+    def get_leds(self, block=True):
+        if self.leds is not None:
+            return self.cached(self.leds, DEV.Request.get_leds, block)
+
+        def parse(data):
+            self.leds = DEV.parse_leds(data)
+            return self.leds
+
+        return self.write(DEV.Request.get_leds, b'', parse, block)
+
+    def set_leds(self, mask, values, block=True):
+        mask = int(mask) & 0xFF
+        values = int(values) & 0xFF
+        if self.led_settings is not None:
+            self.led_settings = (self.led_settings & ~mask) | (values & mask)
+        elif mask == 0xFF:
+            self.led_settings = values
+        if self.leds is not None:
+            self.leds = (self.leds & ~mask) | (values & mask)
+        elif mask == 0xFF:
+            self.leds = values
+        data = struct.pack('!BB', mask, values)
+        return self.write(DEV.Request.set_leds, data, lambda data: True, block)
+
+class AsyncDEV(DEV):
+    def __init__(self, port, window=4, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.port = port
+        self.framer = Framer()
+        self.lock = Lock()
+        self.window = asyncio.Semaphore(window)
+        self.pending = deque()
+        self.event_queue = asyncio.Queue()
+        self.capture = None
+        self.settings = {}
+        self.object_settings = {}
+        self.led_settings = None
+        self.invalidate()
+        self.linked = asyncio.Event()
+        self.done = False
+        self.reconnect_count = 0
+        self.reconnect_handle = None
+        self.restore_task = None
+        self.sync_handle = None
+        self.sync_delay = DEV.sync_interval
+        # Bytes the serial port would not take yet, sent from a writer callback
+        self.output = bytearray()
+        self.serial = None
+        self.open()
+        self.instrument(port)
+
+    def open(self):
+        serial = Serial(self.port, timeout=0)
+        os.set_blocking(serial.fileno(), False)
+        self.serial = serial
+        self.linked.clear()
+        self.framer.reset()
+        self.sync_delay = DEV.sync_interval
+        self.send(Framer.sync)
+        self.loop.add_reader(serial.fileno(), self.reader)
+        self.sync_handle = self.loop.call_later(self.sync_delay, self.resync)
+
+    def close(self):
+        serial, self.serial = self.serial, None
+        if serial is None:
+            return
+        if self.sync_handle:
+            self.sync_handle.cancel()
+            self.sync_handle = None
+        self.loop.remove_reader(serial.fileno())
+        self.loop.remove_writer(serial.fileno())
+        self.output.clear()
+        try:
+            serial.close()
+        except OSError:
+            pass
+
+    def shutdown(self):
+        self.done = True
+        if self.reconnect_handle:
+            self.reconnect_handle.cancel()
+            self.reconnect_handle = None
+        if self.restore_task:
+            self.restore_task.cancel()
+            self.restore_task = None
+        self.close()
+        self.cancel_pending()
+
+    def disconnect(self):
+        self.close()
+        self.fail_pending(DEV.LinkError('%s disconnected' % self.port))
+        delay = DEV.reconnect_delays[0]
+        self.reconnect_handle = self.loop.call_later(delay, self.reconnect, delay)
+
+    def reconnect(self, delay):
+        self.reconnect_handle = None
+        try:
+            self.open()
+        except OSError:
+            delay = min(delay * 2, DEV.reconnect_delays[1])
+            self.reconnect_handle = self.loop.call_later(delay, self.reconnect, delay)
+            return
+        self.reconnect_count += 1
+        self.invalidate()
+        if self.restore_task:
+            self.restore_task.cancel()
+        self.restore_task = self.loop.create_task(self.restore())
+
+    async def restore(self):
+        delay, max_delay = DEV.reconnect_delays
+        attempt = 0
+        while not self.done:
+            await self.linked.wait()
+            try:
+                rejected = await self.replay()
+            except (DEV.LinkError, DEV.ResponseErr) as e:
+                attempt += 1
+                if attempt >= DEV.restore_attempts:
+                    log.error('%s: giving up restoring radio settings: %s', self.port, e)
+                    return
+                log.warning('%s: restoring radio settings failed, retrying: %s', self.port, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+            if rejected:
+                log.warning('%s: radio rejected restored settings: %s', self.port, ', '.join(rejected))
+            else:
+                log.info('%s: restored radio settings after reconnect', self.port)
+            return
+
+    async def replay(self):
+        rejected = []
+        for param, value in list(self.settings.items()):
+            if (await self.set_value(param, value))[0] != DEV.Result.ok:
+                rejected.append(param.name)
+        for param, value in list(self.object_settings.items()):
+            if (await self.set_object(param, value))[0] != DEV.Result.ok:
+                rejected.append(param.name)
+        if self.led_settings is not None:
+            await self.set_leds(0xFF, self.led_settings)
+        return rejected
+
+    def cached(self, result, request, block=True):
+        DEV.cache_hits.inc(request.name)
+        future = self.loop.create_future()
+        future.set_result(result)
+        if block:
+            return future
+        # Awaiting a non-blocking request yields its future, as write does
+        queued = self.loop.create_future()
+        queued.set_result(future)
+        return queued
+
+    def send(self, data):
+        fd = self.serial.fileno()
+        if not self.output:
+            try:
+                n = os.write(fd, data)
+            except BlockingIOError:
+                n = 0
+            if n == len(data):
+                return
+            data = memoryview(data)[n:]
+            self.loop.add_writer(fd, self.flush)
+        self.output += data
+
+    def flush(self):
+        try:
+            n = os.write(self.serial.fileno(), self.output)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.disconnect()
+            return
+        del self.output[:n]
+        if not self.output:
+            self.loop.remove_writer(self.serial.fileno())
+
+    def resync(self):
+        self.sync_handle = None
+        if not self.framer.synced:
+            with self.lock:
+                try:
+                    self.send(Framer.sync)
+                except OSError:
+                    pending = None
+                else:
+                    pending, self.pending = self.pending, deque()
+            if pending is None:
+                self.disconnect()
+                return
+            self.fail(pending, DEV.LinkError('%s lost sync' % self.port))
+            # Back off while a slow radio has yet to answer the first sync
+            if not self.linked.is_set():
+                self.sync_delay = min(self.sync_delay * 2, DEV.reconnect_delays[1])
+            self.sync_handle = self.loop.call_later(self.sync_delay, self.resync)
+
+    def reader(self):
+        try:
+            data = os.read(self.serial.fileno(), 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.disconnect()
+            return
+        if not data:
+            self.disconnect()
+            return
+        self.feed(data)
+        if self.framer.synced:
+            if not self.linked.is_set():
+                self.linked.set()
+                self.sync_delay = DEV.sync_interval
+        elif self.sync_handle is None:
+            self.resync()
+
+    async def write(self, cmd, data=b'', parse=None, block=True):
+        packet = DEV.header_struct.pack(cmd.value, len(data)) + data
+        future = self.loop.create_future()
+        # Wait for the first sync echo, so a slow radio cannot pair a late echo with the wrong responses
+        if not self.linked.is_set():
+            try:
+                await asyncio.wait_for(self.linked.wait(), DEV.link_timeout)
+            except asyncio.TimeoutError:
+                raise DEV.LinkError('%s did not answer sync' % self.port) from None
+        await self.window.acquire()
+        with self.lock:
+            if self.serial is None:
+                self.window.release()
+                raise DEV.LinkError('%s is not connected' % self.port)
+            self.pending.append((future, parse, cmd, perf_counter()))
+            try:
+                self.send(packet)
+            except OSError as e:
+                self.pending.pop()
+                self.window.release()
+                raise DEV.LinkError(str(e)) from e
+            except:
+                self.pending.pop()
+                self.window.release()
+                raise
+        if block:
+            return await future
+        return future
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.event_queue.get()
+
+class DEVGroup(object):
+    class Inbox(object):
+        def __init__(self, queue, radio):
+            self.queue = queue
+            self.radio = radio
+
+        def put_nowait(self, item):
+            self.queue.put_nowait(item + (self.radio,))
+
+        def qsize(self):
+            return self.queue.qsize()
+
+    # Most recently heard sources to remember the radio of; older ones fall back to the current radio
+    max_routes = 1024
+
+    def __init__(self, ports, window=4):
+        self.inbox = Queue()
+        self.radios = []
+        for i, port in enumerate(ports):
+            self.radios.append(DEV(port, window, DEVGroup.Inbox(self.inbox, i)))
+        self.current = self.radios[0]
+        self.routes = OrderedDict()
+
+    @property
+    def event_queue(self):
+        return self
+
+    def qsize(self):
+        return self.inbox.qsize()
+
+    def get(self, block=True, timeout=None):
+        event, data, radio = self.inbox.get(block, timeout)
+        self.current = self.radios[radio]
+        if event == DEV.Event.on_packet:
+            # Malformed frames are left for the packet handler to reject
+            try:
+                mhr = MHR.View(data[0])
+                src_addr = mhr.src_addr if mhr.supported else None
+            except (AttributeError, IndexError, ValueError):
+                src_addr = None
+            if src_addr is not None:
+                self.routes[src_addr] = self.current
+                self.routes.move_to_end(src_addr)
+                if len(self.routes) > DEVGroup.max_routes:
+                    self.routes.popitem(last=False)
+        return event, data
+
+    def route(self, packet):
+        try:
+            mhr = MHR.View(packet)
+            if mhr.supported:
+                return self.routes.get(mhr.dst_addr, self.current)
+        except (AttributeError, IndexError, ValueError):
+            pass
+        return self.current
+
+    def broadcast(self, method, *args, block=True):
+        futures = [getattr(radio, method)(*args, block=False) for radio in self.radios]
+        if block:
+            return [future.result() for future in futures][0]
+        return futures[0]
+
+    def shutdown(self):
+        for radio in self.radios:
+            radio.shutdown()
+
+    def send_packet(self, data, block=True):
+        return self.route(data).send_packet(data, block)
+
+    def get_mem(self, addr, n=1, reverse=False, block=True):
+        return self.radios[0].get_mem(addr, n, reverse, block)
+
+    def set_mem(self, addr, data, reverse=False, block=True):
+        return self.broadcast('set_mem', addr, data, reverse, block=block)
+
+    def get_value(self, param, block=True):
+        return self.radios[0].get_value(param, block)
+
+    def set_value(self, param, value, block=True):
+        return self.broadcast('set_value', param, value, block=block)
+
+    def get_object(self, param, expected_len, block=True):
+        return self.radios[0].get_object(param, expected_len, block)
+
+    def set_object(self, param, data, block=True):
+        return self.broadcast('set_object', param, data, block=block)
+
+    def get_leds(self, block=True):
+        return self.radios[0].get_leds(block)
+
+    def set_leds(self, mask, values, block=True):
+        return self.broadcast('set_leds', mask, values, block=block)
 
 class MHR(object):
     @unique
@@ -276,77 +1003,151 @@ class MHR(object):
         def __str__(self):
             return str(self.name)
 
+    class Layout(object):
+        def __init__(self, frame_control):
+            version = (frame_control >> MHR.FrameControl.version) & 0x3
+            dst_mode = MHR.AddrMode((frame_control >> MHR.FrameControl.dst_mode) & 0x3)
+            src_mode = MHR.AddrMode((frame_control >> MHR.FrameControl.src_mode) & 0x3)
+            panid_compression = (frame_control >> MHR.FrameControl.panid_compression) & 1
+
+            self.supported = version <= MHR.Version.version_2006
+            self.compressed = False
+
+            fields = [('frame_control', 'H'), ('seq_num', 'B')]
+            if dst_mode != MHR.AddrMode.none:
+                fields.append(('dst_panid', 'H'))
+            if dst_mode == MHR.AddrMode.short:
+                fields.append(('dst_addr', 'H'))
+            elif dst_mode == MHR.AddrMode.long:
+                fields.append(('dst_addr', '8s'))
+
+            encode_fields = list(fields)
+            if src_mode != MHR.AddrMode.none:
+                if panid_compression and dst_mode != MHR.AddrMode.none:
+                    self.compressed = True
+                else:
+                    fields.append(('src_panid', 'H'))
+                if not panid_compression:
+                    encode_fields.append(('src_panid', 'H'))
+            if src_mode == MHR.AddrMode.short:
+                fields.append(('src_addr', 'H'))
+                encode_fields.append(('src_addr', 'H'))
+            elif src_mode == MHR.AddrMode.long:
+                fields.append(('src_addr', '8s'))
+                encode_fields.append(('src_addr', '8s'))
+
+            self.offsets = {}
+            offset = 0
+            for field, code in fields:
+                self.offsets[field] = (offset, code)
+                offset += struct.calcsize('!' + code)
+            if self.compressed:
+                self.offsets['src_panid'] = self.offsets['dst_panid']
+            self.view_fields = tuple(self.offsets)
+
+            self.struct = struct.Struct('!' + ''.join(code for _, code in fields))
+            self.fields = tuple(field for field, _ in fields)
+            self.size = self.struct.size
+            self.decode = self.compile()
+            if encode_fields == fields:
+                self.encode_struct = self.struct
+            else:
+                self.encode_struct = struct.Struct('!' + ''.join(code for _, code in encode_fields))
+            self.getter = attrgetter(*(field for field, _ in encode_fields))
+
+        def compile(self):
+            source = 'def decode(cls, data):\n'
+            source += '    mhr = new(cls)\n'
+            source += '    %s, = unpack_from(data)\n' % ', '.join('mhr.' + field for field in self.fields)
+            if self.compressed:
+                source += '    mhr.src_panid = mhr.dst_panid\n'
+            source += '    return mhr, data[%d:]\n' % self.size
+            namespace = {'new': object.__new__, 'unpack_from': self.struct.unpack_from}
+            exec(source, namespace)
+            return namespace['decode']
+
+    frame_control_struct = struct.Struct('!H')
+    seq_num_offset = 2
+    # Only these bits change the shape of the header, so they alone key the layout cache
+    layout_mask = ((0x3 << FrameControl.dst_mode) | (0x3 << FrameControl.src_mode) |
+                   (0x3 << FrameControl.version) | (1 << FrameControl.panid_compression))
+    layouts = {}
+
+    @staticmethod
+    def layout(frame_control):
+        key = frame_control & MHR.layout_mask
+        layout = MHR.layouts.get(key)
+        if layout is None:
+            layout = MHR.layouts[key] = MHR.Layout(key)
+        return layout
+
     @classmethod
     def decode(cls, data):
-        mhr = cls()
-
-        offset = 0
-        mhr.frame_control, mhr.seq_num = struct.unpack_from('!HB', data, offset)
-        if (mhr.frame_control >> MHR.FrameControl.version) & 0x3 > MHR.Version.version_2006:
+        frame_control, = MHR.frame_control_struct.unpack_from(data)
+        layout = MHR.layouts.get(frame_control & MHR.layout_mask) or MHR.layout(frame_control)
+        if not layout.supported:
             return
-        offset += 3
+        return layout.decode(cls, data)
 
-        dst_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.dst_mode) & 0x3)
+    def __init__(self):
+        self.frame_control = 0
+        self.seq_num = 0
 
-        if dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
-            mhr.dst_panid, = struct.unpack_from('!H', data, offset)
-            offset += 2
+    def size(self):
+        layout = MHR.layouts.get(self.frame_control & MHR.layout_mask) or MHR.layout(self.frame_control)
+        return layout.encode_struct.size
 
-        if dst_mode == MHR.AddrMode.short:
-            mhr.dst_addr, = struct.unpack_from('!H', data, offset)
-            offset += 2
-        elif dst_mode == MHR.AddrMode.long:
-            mhr.dst_addr = data[offset:offset + 8]
-            offset += 8
+    def encode(self):
+        layout = MHR.layouts.get(self.frame_control & MHR.layout_mask) or MHR.layout(self.frame_control)
+        return layout.encode_struct.pack(*layout.getter(self))
 
-        src_mode = MHR.AddrMode((mhr.frame_control >> MHR.FrameControl.src_mode) & 0x3)
-        
-        panid_compression = (mhr.frame_control >> MHR.FrameControl.panid_compression) & 1
-        if src_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
-            if panid_compression and dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
-                mhr.src_panid = mhr.dst_panid
-            else:
-                mhr.src_panid, = struct.unpack_from('!H', data, offset)
-                offset += 2
-       
-        if src_mode == MHR.AddrMode.short:
-            mhr.src_addr, = struct.unpack_from('!H', data, offset)
-            offset += 2
-        elif src_mode == MHR.AddrMode.long:
-            mhr.src_addr = data[offset:offset + 8]
-            offset += 8
+    def encode_into(self, buffer, offset=0):
+        layout = MHR.layouts.get(self.frame_control & MHR.layout_mask) or MHR.layout(self.frame_control)
+        layout.encode_struct.pack_into(buffer, offset, *layout.getter(self))
+        return offset + layout.encode_struct.size
 
-        return mhr, data[offset:]
+    class View(object):
+        __slots__ = ('data', 'frame_control', '_layout')
 
-    def __init__(self):
-        self.frame_control = 0
-        self.seq_num = 0
+        def __init__(self, data):
+            self.data = data
+            self.frame_control = (data[0] << 8) | data[1]
+            self._layout = None
 
-    def encode(self):
-        data = struct.pack('!HB', self.frame_control, self.seq_num)
-
-        dst_mode = MHR.AddrMode((self.frame_control >> MHR.FrameControl.dst_mode) & 0x3)
-    
-        if dst_mode in [MHR.AddrMode.short, MHR.AddrMode.long]:
-            data += struct.pack('!H', self.dst_panid)
-        
-        if dst_mode == MHR.AddrMode.short:
-            data += struct.pack('!H', self.dst_addr)
-        elif dst_mode == MHR.AddrMode.long:
-            data += self.dst_addr
-        
-        src_mode = MHR.AddrMode((self.frame_control >> MHR.FrameControl.src_mode) & 0x3)
-
-        panid_compression = (self.frame_control >> MHR.FrameControl.panid_compression) & 1
-        if src_mode in [MHR.AddrMode.short, MHR.AddrMode.long] and not panid_compression:
-            data += struct.pack('!H', self.src_panid)
-
-        if src_mode == MHR.AddrMode.short:
-            data += struct.pack('!H', self.src_addr)
-        elif src_mode == MHR.AddrMode.long:
-            data += self.src_addr
-        
-        return data
+        @property
+        def layout(self):
+            if self._layout is None:
+                self._layout = MHR.layouts.get(self.frame_control & MHR.layout_mask) or MHR.layout(self.frame_control)
+            return self._layout
+
+        @property
+        def frame_type(self):
+            return self.frame_control & 0x7
+
+        @property
+        def seq_num(self):
+            return self.data[2]
+
+        @property
+        def supported(self):
+            return self.layout.supported
+
+        @property
+        def fields(self):
+            return self.layout.view_fields
+
+        @property
+        def payload(self):
+            return memoryview(self.data)[self.layout.size:]
+
+        def __getattr__(self, name):
+            try:
+                offset, code = self.layout.offsets[name]
+            except KeyError:
+                raise AttributeError(name) from None
+            if code == 'H':
+                return (self.data[offset] << 8) | self.data[offset + 1]
+            return bytes(self.data[offset:offset + 8])
 
 class BCN(object):
     @unique
@@ -417,7 +1218,7 @@ class BCN(object):
 
         num_long = (pend_addr_spec >> 4) & 7
         for _ in range(num_long):
-            long_addr = data[offset:offset + 8]
+            long_addr = bytes(data[offset:offset + 8])
             bcn.pend_addr.append(long_addr)
             offset += 8
 
@@ -429,7 +1230,7 @@ class BCN(object):
         ssid_len, = struct.unpack_from('!B',data, offset)
         offset += 1
         ssid = data[offset:offset + ssid_len]
-        bcn.ssid = ssid.decode('utf8')
+        bcn.ssid = str(ssid, 'utf8')
         offset += ssid_len
 
         num_services, = struct.unpack_from('!B', data, offset)
@@ -448,40 +1249,100 @@ class BCN(object):
         self.ssid = b''
         self.services = []
 
+    def pend_addr_split(self):
+        short_addr, long_addr = [], []
+        for addr in self.pend_addr:
+            if isinstance(addr, int):
+                short_addr.append(addr)
+            else:
+                long_addr.append(addr)
+        return short_addr, long_addr
+
+    def size(self):
+        size = 3
+        num_desc = self.gts_spec & 0x3
+        if num_desc > 0:
+            size += 1 + 3 * num_desc
+        short_addr, long_addr = self.pend_addr_split()
+        size += 1 + 2 * len(short_addr) + 8 * len(long_addr)
+        size += 4 + 1 + len(self.ssid.encode('utf8')) + 1 + 2 * len(self.services)
+        return size
+
     def encode(self):
-        data = struct.pack('!HB', self.superframe, self.gts_spec)
+        data = bytearray(self.size())
+        self.encode_into(data)
+        return bytes(data)
+
+    def encode_into(self, buffer, offset=0):
+        struct.pack_into('!HB', buffer, offset, self.superframe, self.gts_spec)
+        offset += 3
+
         num_desc = self.gts_spec & 0x3
         if (num_desc > 0):
-            data += struct.pack('!B', self.gts_mask)
+            struct.pack_into('!B', buffer, offset, self.gts_mask)
+            offset += 1
             for i in range(num_desc):
                 desc = self.gts_desc[i]
-                data += struct.pack('!HB', desc & 0xFFFF, desc >> 16)
+                struct.pack_into('!HB', buffer, offset, desc & 0xFFFF, desc >> 16)
+                offset += 3
 
-        short_addr, long_addr = [], []
-        for addr in self.pend_addr:
-            if isinstance(addr, int):
-                short_addr.append(addr)
-            elif isinstance(addr, bytes):
-                long_addr.append(addr)
-        
-        data += struct.pack('!B', (len(long_addr) << 4) | len(short_addr))
+        short_addr, long_addr = self.pend_addr_split()
+        struct.pack_into('!B', buffer, offset, (len(long_addr) << 4) | len(short_addr))
+        offset += 1
         for addr in short_addr:
-            data += struct.pack('!H', addr)
-        
+            struct.pack_into('!H', buffer, offset, addr)
+            offset += 2
         for addr in long_addr:
-            data += long_addr
+            struct.pack_into('!8s', buffer, offset, addr)
+            offset += 8
 
-        data += b'Zag!'
+        struct.pack_into('!4s', buffer, offset, b'Zag!')
+        offset += 4
 
         ssid = self.ssid.encode('utf8')
-        data += struct.pack('!B', len(ssid))
-        data += ssid
+        struct.pack_into('!B%ds' % len(ssid), buffer, offset, len(ssid), ssid)
+        offset += 1 + len(ssid)
 
-        data += struct.pack('!B', len(self.services))
+        struct.pack_into('!B', buffer, offset, len(self.services))
+        offset += 1
         for service in self.services:
-            data += struct.pack('!H', service)
+            struct.pack_into('!H', buffer, offset, service)
+            offset += 2
 
-        return data
+        return offset
+
+    class View(object):
+        __slots__ = ('data', '_decoded')
+
+        def __init__(self, data):
+            self.data = data
+            self._decoded = None
+
+        @property
+        def superframe(self):
+            return (self.data[0] << 8) | self.data[1]
+
+        @property
+        def gts_spec(self):
+            return self.data[2]
+
+        @property
+        def fields(self):
+            if self.gts_spec & 0x3:
+                return ('superframe', 'gts_spec', 'gts_mask', 'gts_desc', 'pend_addr', 'ssid', 'services')
+            return ('superframe', 'gts_spec', 'pend_addr', 'ssid', 'services')
+
+        def decoded(self):
+            if self._decoded is None:
+                self._decoded = BCN.decode(self.data)
+            return self._decoded
+
+        @property
+        def payload(self):
+            return self.decoded()[1]
+
+        def __getattr__(self, name):
+            return getattr(self.decoded()[0], name)
 
 class CMD(object):
     @unique
@@ -533,61 +1394,104 @@ class CMD(object):
         def __str__(self):
             return str(self.name)
 
+    layouts = {
+        Identifier.association_request:         (struct.Struct('!B'), ('capability',)),
+        Identifier.association_response:        (struct.Struct('!HB'), ('short_addr', 'status')),
+        Identifier.disassociation_notification: (struct.Struct('!B'), ('reason',)),
+        Identifier.coordinator_realignment:     (struct.Struct('!HHBH'), ('panid', 'coord_addr', 'channel', 'short_addr')),
+        Identifier.gts_request:                 (struct.Struct('!B'), ('characteristics',)),
+    }
+
+    defaults = {
+        'capability': 0,
+        'short_addr': None,
+        'status': 0,
+        'reason': 0,
+        'panid': 0,
+        'coord_addr': 0,
+        'channel': 0,
+        'characteristics': 0,
+    }
+
     @classmethod
     def decode(cls, data):
         cmd = cls()
 
-        offset = 0
-        identifier, = struct.unpack_from('!B', data, offset)
-        cmd.identifier = CMD.Identifier(identifier)
-        offset += 1
+        cmd.identifier = CMD.Identifier(data[0])
+        offset = 1
 
-        if cmd.identifier == CMD.Identifier.association_request:
-            cmd.capability, = struct.unpack_from('!B', data, offset)
-            offset += 1
-        elif cmd.identifier == CMD.Identifier.association_response:
-            cmd.short_addr, cmd.status = struct.unpack_from('!HB', data, offset)
-            offset += 3
-        elif cmd.identifier == CMD.Identifier.disassociation_notification:
-            cmd.reason, = struct.unpack_from('!B', data, offset)
-            offset += 1
-        elif cmd.identifier == CMD.Identifier.coordinator_realignment:
-            cmd.panid, cmd.coord_addr, cmd.channel, cmd.short_addr = struct.unpack_from('!HHBH', data, offset)
-            offset += 7
-        elif cmd.identifier == CMD.Identifier.gts_request:
-            cmd.characteristics == struct.unpack_from('!B', data, offset)
-            offset += 1
+        layout = CMD.layouts.get(cmd.identifier)
+        if layout:
+            fmt, fields = layout
+            for field, value in zip(fields, fmt.unpack_from(data, offset)):
+                setattr(cmd, field, value)
+            offset += fmt.size
 
         return cmd, data[offset:]
 
     def __init__(self):
-        self.capability = 0
-        self.short_addr = None
-        self.status = 0
-        self.reason = 0
-        self.panid = 0
-        self.coord_addr = 0
-        self.channel = 0
-        self.characteristics = 0
+        self.__dict__.update(CMD.defaults)
+
+    def size(self):
+        layout = CMD.layouts.get(self.identifier)
+        if layout:
+            return 1 + layout[0].size
+        return 1
 
     def encode(self):
-        data = struct.pack('!B', self.identifier)
-        if self.identifier == CMD.Identifier.association_request:
-            data += struct.pack('!B', self.capability)
-        elif self.identifier == CMD.Identifier.association_response:
-            data += struct.pack('!HB', self.short_addr, self.status)
-        elif self.identifier == CMD.Identifier.disassociation_notification:
-            data += struct.pack('!B', self.reason)
-        elif self.identifier == CMD.Identifier.coordinator_realignment:
-            data += struct.pack('!HHBH', self.panid, self.coord_addr, self.channel, self.short_addr)
-        elif self.identifier == CMD.Identifier.gts_request:
-            data += struct.pack('!B', self.characteristics)
-
-        return data
+        data = bytearray(self.size())
+        self.encode_into(data)
+        return bytes(data)
 
-def debug_object(o):
+    def encode_into(self, buffer, offset=0):
+        struct.pack_into('!B', buffer, offset, self.identifier)
+        offset += 1
+        layout = CMD.layouts.get(self.identifier)
+        if layout:
+            fmt, fields = layout
+            fmt.pack_into(buffer, offset, *[getattr(self, field) for field in fields])
+            offset += fmt.size
+
+        return offset
+
+    class View(object):
+        __slots__ = ('data',)
+
+        def __init__(self, data):
+            self.data = data
+
+        @property
+        def identifier(self):
+            return CMD.Identifier(self.data[0])
+
+        @property
+        def fields(self):
+            layout = CMD.layouts.get(self.data[0])
+            if layout:
+                return ('identifier',) + layout[1]
+            return ('identifier',)
+
+        @property
+        def payload(self):
+            layout = CMD.layouts.get(self.data[0])
+            if layout:
+                return self.data[1 + layout[0].size:]
+            return self.data[1:]
+
+        def __getattr__(self, name):
+            layout = CMD.layouts.get(self.data[0])
+            if layout and name in layout[1]:
+                fmt, fields = layout
+                return fmt.unpack_from(self.data, 1)[fields.index(name)]
+            try:
+                return CMD.defaults[name]
+            except KeyError:
+                raise AttributeError(name) from None
+
+def format_fields(o, fields):
     l = []
-    for k, v in vars(o).items():
+    for k in fields:
+        v = getattr(o, k)
         if isinstance(v, IntEnum):
             v = repr(v)
         elif isinstance(v, int):
@@ -595,9 +1499,10 @@ def debug_object(o):
         else:
             v = repr(v)
         l.append('%s:%s' % (k, v))
-    s = str(type(o)) + ': '
-    s += ', '.join(l)
-    print(s)
+    return ', '.join(l)
+
+def debug_object(o):
+    print(str(type(o)) + ': ' + format_fields(o, vars(o)))
 
 def debug_packet(packet):
     mhr, payload = MHR.decode(packet)